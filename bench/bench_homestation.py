@@ -0,0 +1,311 @@
+'''
+HomeStation benchmark
+Runs the real drivers and homestation.serve_client on Linux CPython, against the simulated PiicoDev parts in
+fakei2c.py and a crowd of simulated browsers, so regressions in the driver and server hot paths show up as
+numbers without any hardware:
+
+    python3 bench/bench_homestation.py
+    python3 bench/bench_homestation.py --clients 50 --duration 20 --paths /api/sensors.bin --json
+
+Reports driver cost (I2C transactions and time per reading), server throughput (requests/s, p50/p99 latency, 503s),
+I2C transactions per sensor snapshot while serving, and peak Python heap (tracemalloc). Finishes by sending a few
+malformed requests, which must all be answered without leaving a connection open.
+CPython on a PC is much faster than a Pico W, so compare numbers between runs of this script, not with the device.
+'''
+
+import os
+import sys
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(HERE)
+sys.path[:0] = [os.path.join(HERE, 'shims'), HERE, ROOT, os.path.join(ROOT, 'lib')]
+
+import argparse
+import asyncio
+import contextlib
+import json
+import time
+import tracemalloc
+
+# MicroPython's time extras, which homestation calls directly
+time.ticks_ms = lambda: int(time.monotonic()*1000)
+time.ticks_us = lambda: int(time.monotonic()*1000000)
+time.ticks_diff = lambda a, b: a - b
+time.ticks_add = lambda a, b: a + b
+
+import fakei2c
+
+def percentile(sorted_values, q):
+    if not sorted_values:
+        return float('nan')
+    return sorted_values[min(len(sorted_values)-1, int(q*len(sorted_values)))]
+
+# Average transactions and wall time per call of fn
+def perCall(bus, fn, n):
+    bus.resetStats()
+    t0 = time.perf_counter()
+    for _ in range(n):
+        fn()
+    dt = time.perf_counter() - t0
+    return {'transactions': bus.transactions/n, 'bus_ms': bus.busyMs/n, 'ms': dt*1000/n}
+
+def benchDrivers(args):
+    from PiicoDev_BME280 import PiicoDev_BME280, compensate_batch
+    from PiicoDev_VEML6030 import PiicoDev_VEML6030
+    from PiicoDev_RGB import PiicoDev_RGB
+    bus = fakei2c.homestation(freq=args.freq, delay=not args.no_bus_delay)
+    results = {}
+    forced = PiicoDev_BME280()
+    results['bme280_forced'] = perCall(bus, forced.values, 10)
+    normal = PiicoDev_BME280(normal_mode=True, t_sb=0)
+    results['bme280_normal'] = perCall(bus, normal.values, 200)
+    light = PiicoDev_VEML6030()
+    results['veml6030'] = perCall(bus, light.read, 200)
+    leds = PiicoDev_RGB()
+    results['rgb_show_unchanged'] = perCall(bus, leds.show, 200)
+    colours = [[i, 255-i, 0] for i in range(200)]
+    def showNew():
+        leds.setPixel(0, colours.pop())
+        leds.show()
+    results['rgb_show_changed'] = perCall(bus, showNew, 200)
+    n = 100000
+    raw = [520608]*n, [341696]*n, [28204]*n
+    t0 = time.perf_counter()
+    compensate_batch(normal.calibration(), *raw)
+    results['bme280_batch_per_s'] = n / (time.perf_counter() - t0)
+    return results
+
+# One simulated browser: keep-alive GETs over the path mix, reconnecting whenever the server closes
+async def client(port, paths, deadline, latencies, errors, rejected):
+    i = 0
+    reader = writer = None
+    while time.monotonic() < deadline:
+        try:
+            if writer is None:
+                reader, writer = await asyncio.open_connection('127.0.0.1', port)
+            path = paths[i % len(paths)]
+            i += 1
+            t0 = time.perf_counter()
+            writer.write('GET {} HTTP/1.1\r\nHost: bench\r\nAccept-Encoding: gzip\r\n\r\n'.format(path).encode())
+            await writer.drain()
+            status = await reader.readline()
+            if not status:
+                raise ConnectionError('closed before the response')
+            length = 0
+            close = False
+            retryAfter = 0
+            while True:
+                line = await reader.readline()
+                if line in (b'\r\n', b''):
+                    break
+                name, _, value = line.partition(b':')
+                name = name.strip().lower()
+                if name == b'content-length':
+                    length = int(value)
+                elif name == b'connection' and value.strip().lower() == b'close':
+                    close = True
+                elif name == b'retry-after':
+                    retryAfter = int(value)
+            if length:
+                await reader.readexactly(length)
+            if status[9:12] == b'503': # Turned away by admission control, come back when told to like a polling page
+                rejected.append(path)
+                await asyncio.sleep(retryAfter)
+            else:
+                latencies.append(time.perf_counter() - t0)
+            if close:
+                writer.close()
+                writer = None
+        except (OSError, ConnectionError, asyncio.IncompleteReadError, ValueError):
+            errors.append(path)
+            if writer is not None:
+                writer.close()
+            writer = None
+    if writer is not None:
+        writer.close()
+
+# A dashboard holding /events open, counting pushed updates. Retries after a 503 like EventSource does.
+async def sseClient(port, deadline, counts):
+    n = 0
+    while time.monotonic() < deadline:
+        reader, writer = await asyncio.open_connection('127.0.0.1', port)
+        writer.write(b'GET /events HTTP/1.1\r\nHost: bench\r\n\r\n')
+        await writer.drain()
+        try:
+            while time.monotonic() < deadline:
+                line = await asyncio.wait_for(reader.readline(), max(0.01, deadline - time.monotonic()))
+                if not line:
+                    break
+                if line[9:12] == b'503':
+                    await asyncio.sleep(1)
+                    break
+                if line[:5] == b'data:':
+                    n += 1
+        except asyncio.TimeoutError:
+            pass
+        writer.close()
+    counts.append(n)
+
+# Requests a browser would never send, each must get a status line back and leave no connection behind
+MALFORMED = (
+    b'GET /ws?sensors=%FF HTTP/1.1\r\nSec-WebSocket-Key: dGhlIHNhbXBsZSBub25jZQ==\r\n\r\n',
+    b'GET /led_set?state=%FF%FE%FD HTTP/1.1\r\n\r\n',
+    b'GET /log?from=%zz HTTP/1.1\r\n\r\n',
+    b'GET  / HTTP/1.1\r\n\r\n',
+    b'GET / HTTP/1.1\r\nContent-Length: -1\r\n\r\n',
+    b'GET / HTTP/1.1\r\n' + b'X: y\r\n'*64 + b'\r\n',
+)
+
+async def probeMalformed(port):
+    answered = 0
+    for request in MALFORMED:
+        reader, writer = await asyncio.open_connection('127.0.0.1', port)
+        writer.write(request)
+        await writer.drain()
+        try:
+            status = await asyncio.wait_for(reader.readline(), 2)
+        except (OSError, asyncio.TimeoutError):
+            status = b''
+        if status[:9] == b'HTTP/1.1 ':
+            answered += 1
+        writer.close()
+    return answered
+
+async def benchServer(args):
+    bus = fakei2c.homestation(freq=args.freq, delay=not args.no_bus_delay, lux=args.lux)
+    import hs_http
+    import hs_metrics
+    import homestation
+    hs_http.max_connections = args.max_connections
+    hs_http.max_queued = args.max_queued
+    hs_http.max_streams = max(hs_http.max_streams, args.sse)
+    from PiicoDev_BME280 import PiicoDev_BME280
+    from PiicoDev_VEML6030 import PiicoDev_VEML6030
+    from PiicoDev_RGB import PiicoDev_RGB
+
+    # The same sensors as main_culled.py
+    atmo = PiicoDev_BME280(normal_mode=True, t_sb=5)
+    lght = PiicoDev_VEML6030(autoRange=True)
+    leds = PiicoDev_RGB()
+    async def atmoSplit():
+        tempC, presPa, humRH = await atmo.values_async()
+        return tempC, presPa/100, humRH
+    sensors = homestation.SensorRegistry()
+    sensors.addGroup("Atmo", atmoSplit, interval=args.atmo_interval)
+    sensors.addField("Temperature:", 'Atmo', 0, units=' &#8451;', fmt='{:.1f}')
+    sensors.addField("Pressure:", 'Atmo', 1, units='hPa', fmt='{:.0f}')
+    sensors.addField("Humidity:", 'Atmo', 2, units='%', fmt='{:.1f}')
+    sensors.addSensor("Light:", lght.read, interval=args.light_interval, units='lx', fmt='{:.1f}')
+    def setLeds(colour):
+        for i in range(3):
+            leds.setPixel(i, colour)
+        leds.show()
+    homestation.setLightHandler(setLeds)
+
+    sampler = asyncio.create_task(homestation.sampleSensors(sensors))
+    server = await asyncio.start_server(homestation.serve_client, '127.0.0.1', 0, backlog=max(100, args.clients))
+    port = server.sockets[0].getsockname()[1]
+    while homestation.sensorSnapshot['readings'] is None:
+        await asyncio.sleep(0.01)
+
+    if args.memory:
+        tracemalloc.start()
+    bus.resetStats()
+    seq0 = homestation.sensorSnapshot['seq']
+    latencies, errors, rejected, sseCounts = [], [], [], []
+    t0 = time.monotonic()
+    deadline = t0 + args.duration
+    tasks = [asyncio.create_task(client(port, args.paths, deadline, latencies, errors, rejected)) for _ in range(args.clients)]
+    tasks += [asyncio.create_task(sseClient(port, deadline, sseCounts)) for _ in range(args.sse)]
+    await asyncio.gather(*tasks)
+    elapsed = time.monotonic() - t0
+    peak = tracemalloc.get_traced_memory()[1] if args.memory else None
+    if args.memory:
+        tracemalloc.stop()
+    readings = homestation.sensorSnapshot['seq'] - seq0
+
+    malformedAnswered = await probeMalformed(port)
+
+    # Let the handlers notice their clients have gone (/events ones on the next sample), then stop the sampler
+    server.close()
+    handlers = [task for task in asyncio.all_tasks() if task not in (asyncio.current_task(), sampler)]
+    if handlers:
+        done, stuck = await asyncio.wait(handlers, timeout=5)
+        for task in stuck:
+            task.cancel()
+    sampler.cancel()
+    await server.wait_closed()
+
+    latencies.sort()
+    return {
+        'requests': len(latencies),
+        'errors': len(errors),
+        'rejected': len(rejected),
+        'requests_per_s': len(latencies)/elapsed,
+        'p50_ms': percentile(latencies, 0.50)*1000,
+        'p99_ms': percentile(latencies, 0.99)*1000,
+        'max_ms': latencies[-1]*1000 if latencies else float('nan'),
+        'readings': readings,
+        'i2c_transactions': bus.transactions,
+        'i2c_per_reading': bus.transactions/readings if readings else float('nan'),
+        'i2c_per_device': {'0x{:02X}'.format(addr): n for addr, n in sorted(bus.perAddr.items())},
+        'i2c_bus_ms': bus.busyMs,
+        'sse_updates': sum(sseCounts),
+        'malformed_answered': malformedAnswered,
+        'malformed_sent': len(MALFORMED),
+        'connections_left_open': hs_metrics.activeConnections.value,
+        'peak_heap_kb': peak/1024 if peak is not None else None,
+    }
+
+def report(drivers, server, args):
+    print('Drivers ({} kHz bus{})'.format(args.freq//1000, ', no wire delay' if args.no_bus_delay else ''))
+    for name in ('bme280_forced', 'bme280_normal', 'veml6030', 'rgb_show_unchanged', 'rgb_show_changed'):
+        r = drivers[name]
+        print('  {:<20} {:5.1f} transactions  {:7.3f} ms bus  {:8.3f} ms/call'.format(name, r['transactions'], r['bus_ms'], r['ms']))
+    print('  {:<20} {:,.0f} samples/s'.format('bme280 batch', drivers['bme280_batch_per_s']))
+    print('Server ({} clients{}, {} s, paths {})'.format(args.clients, ' + {} /events'.format(args.sse) if args.sse else '',
+                                                           args.duration, ','.join(args.paths)))
+    print('  {:,} requests, {} errors, {} rejected (503), {:.0f} req/s'.format(server['requests'], server['errors'],
+                                                                         server['rejected'], server['requests_per_s']))
+    print('  latency p50 {:.2f} ms  p99 {:.2f} ms  max {:.2f} ms'.format(server['p50_ms'], server['p99_ms'], server['max_ms']))
+    print('  {} sensor readings, {} I2C transactions ({:.1f} per reading, {:.1f} ms on the bus)'.format(
+        server['readings'], server['i2c_transactions'], server['i2c_per_reading'], server['i2c_bus_ms']))
+    print('  per device: ' + ', '.join('{} {}'.format(a, n) for a, n in server['i2c_per_device'].items()))
+    if args.sse:
+        print('  {} /events updates pushed'.format(server['sse_updates']))
+    print('  {}/{} malformed requests answered, {} connections left open'.format(
+        server['malformed_answered'], server['malformed_sent'], server['connections_left_open']))
+    if server['peak_heap_kb'] is not None:
+        print('  peak heap {:.0f} KiB (tracemalloc, slows the run down)'.format(server['peak_heap_kb']))
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark HomeStation against simulated hardware and clients')
+    parser.add_argument('--clients', type=int, default=20, help='concurrent keep-alive clients')
+    parser.add_argument('--sse', type=int, default=0, help='extra clients holding /events open')
+    parser.add_argument('--duration', type=float, default=10, help='seconds of load')
+    parser.add_argument('--paths', type=lambda s: s.split(','), default=['/sensors', '/api/sensors', '/api/sensors.bin', '/'],
+                        help='comma separated paths each client cycles through')
+    parser.add_argument('--max-connections', type=int, default=4, help='hs_http.max_connections (Pico default 4)')
+    parser.add_argument('--max-queued', type=int, default=4, help='hs_http.max_queued')
+    parser.add_argument('--freq', type=int, default=400000, help='simulated I2C clock [Hz]')
+    parser.add_argument('--no-bus-delay', action='store_true', help="don't hold the CPU for the simulated wire time")
+    parser.add_argument('--atmo-interval', type=float, default=2, help='BME280 poll interval [s]')
+    parser.add_argument('--light-interval', type=float, default=0.5, help='VEML6030 poll interval [s]')
+    parser.add_argument('--lux', type=float, default=300, help='simulated ambient light [lx]')
+    parser.add_argument('--no-memory', dest='memory', action='store_false', help='skip tracemalloc peak heap tracking')
+    parser.add_argument('--json', action='store_true', help='print the results as JSON')
+    parser.add_argument('--verbose', action='store_true', help="show the drivers' and server's own prints")
+    args = parser.parse_args()
+
+    with contextlib.ExitStack() as stack:
+        if not args.verbose: # serve_client prints every request, which would dominate the timings
+            stack.enter_context(contextlib.redirect_stdout(stack.enter_context(open(os.devnull, 'w'))))
+        drivers = benchDrivers(args)
+        server = asyncio.run(benchServer(args))
+    if args.json:
+        print(json.dumps({'drivers': drivers, 'server': server}, indent=1))
+    else:
+        report(drivers, server, args)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,235 @@
+'''
+HomeStation benchmark - simulated I2C bus
+Register-level models of the PiicoDev parts HomeStation uses (BME280, VEML6030, RGB), on a bus that counts
+every transaction and, like the real blocking I2C driver, holds the CPU for as long as the transfer would take
+on the wire. Used through the fake smbus2 in bench/shims, so the real drivers run unmodified on CPython.
+'''
+
+import random
+import time
+
+# [us] between a bus transfer starting and the first clock edge, roughly what the Pico's blocking driver costs
+overhead_us = 20
+
+def _now_ms():
+    return time.monotonic()*1000
+
+# A device with an auto-incrementing register pointer, set by the first byte of every write
+class Device:
+    def __init__(self, addr):
+        self.addr = addr
+        self.regs = bytearray(256)
+        self.ptr = 0
+
+    def write(self, data):
+        if not data:
+            return
+        self.ptr = data[0]
+        for b in data[1:]:
+            self.onWrite(self.ptr, b)
+            self.ptr = (self.ptr+1) & 0xFF
+
+    def read(self, n):
+        self.onRead(self.ptr, n)
+        out = bytes(self.regs[(self.ptr+i) & 0xFF] for i in range(n))
+        self.ptr = (self.ptr+n) & 0xFF
+        return out
+
+    def onWrite(self, reg, value):
+        self.regs[reg] = value
+
+    def onRead(self, reg, n):
+        pass
+
+# Oversampling setting -> samples, as ctrl_meas/ctrl_hum encode it
+_OSRS = (0, 1, 2, 4, 8, 16, 16, 16)
+_T_SB_MS = (0.5, 62.5, 125, 250, 500, 1000, 10, 20)
+
+class BME280(Device):
+    # Trimming constants and a starting raw sample from a real part (about 23.6 degC, 996 hPa, 44 %RH)
+    _CAL = bytes.fromhex('706b43676400' '8c8ed3d6d00b2d1e54fff9ff8c3cf8c67017' '004b')
+    _CAL_H = bytes([0x6a, 0x01, 0x00, 0x13, 0x2b, 0x03, 0x1e])
+    _RAW = (341696, 520608, 28204) # pressure, temperature, humidity
+
+    def __init__(self, addr=0x77, noise=True):
+        Device.__init__(self, addr)
+        self.noise = noise
+        self._reset()
+
+    def _reset(self):
+        self.regs[:] = bytes(256)
+        self.regs[0x88:0x88+len(self._CAL)] = self._CAL
+        self.regs[0xE1:0xE8] = self._CAL_H
+        self.regs[0xD0] = 0x60 # chip_id
+        self._busyUntil = None # forced conversion in progress
+        self._nextSample = None # normal mode
+        self.conversions = 0
+        self._sample()
+
+    def measureMs(self):
+        ot = _OSRS[self.regs[0xF4] >> 5]
+        op = _OSRS[(self.regs[0xF4] >> 2) & 7]
+        oh = _OSRS[self.regs[0xF2] & 7]
+        return 1.25 + 2.3*ot + (2.3*op + 0.575 if op else 0) + (2.3*oh + 0.575 if oh else 0)
+
+    def _sample(self):
+        p, t, h = self._RAW
+        if self.noise:
+            p += random.randint(-400, 400)
+            t += random.randint(-200, 200)
+            h += random.randint(-100, 100)
+        self.regs[0xF7:0xFF] = bytes((p >> 12, (p >> 4) & 0xFF, (p & 0xF) << 4,
+                                      t >> 12, (t >> 4) & 0xFF, (t & 0xF) << 4,
+                                      h >> 8, h & 0xFF))
+        self.conversions += 1
+
+    def _update(self):
+        now = _now_ms()
+        if self._busyUntil is not None and now >= self._busyUntil:
+            self._busyUntil = None
+            self._sample()
+            self.regs[0xF4] &= 0xFC # Back to sleep after a forced conversion
+        mode = self.regs[0xF4] & 3
+        if mode == 3 and self._nextSample is not None and now >= self._nextSample:
+            self._sample()
+            period = self.measureMs() + _T_SB_MS[self.regs[0xF5] >> 5]
+            self._nextSample += period * (1 + (now - self._nextSample) // period)
+        measuring = self._busyUntil is not None
+        self.regs[0xF3] = 0x08 if measuring else 0x00
+
+    def onWrite(self, reg, value):
+        if reg == 0xE0:
+            if value == 0xB6:
+                self._reset()
+            return
+        if reg < 0xF2 or reg in (0xF3,) or reg >= 0xF7: # Read-only
+            return
+        self.regs[reg] = value
+        if reg == 0xF4:
+            mode = value & 3
+            if mode in (1, 2):
+                self._busyUntil = _now_ms() + self.measureMs()
+            elif mode == 3:
+                self._nextSample = _now_ms() + self.measureMs()
+            else:
+                self._nextSample = None
+
+    def onRead(self, reg, n):
+        self._update()
+
+class VEML6030(Device):
+    _GAIN = {0b00: 1, 0b01: 2, 0b10: 0.125, 0b11: 0.25}
+    _IT = {0b1100: 25, 0b1000: 50, 0b0000: 100, 0b0001: 200, 0b0010: 400, 0b0011: 800}
+
+    def __init__(self, addr=0x10, lux=300, noise=True):
+        Device.__init__(self, addr)
+        self.lux = lux # Ambient light the sensor sees, change it to exercise auto-ranging
+        self.noise = noise
+        self._settleUntil = 0
+        self._raw = 0
+
+    # 16 bit registers, low byte first
+    def _conf(self):
+        return self.regs[0] | self.regs[1] << 8
+
+    def onWrite(self, reg, value):
+        if reg > 0x03: # ALS, WHITE and ID are read-only
+            return
+        self.regs[reg] = value
+        if reg <= 1: # New gain or integration time - the old count stays until a full integration has run
+            conf = self._conf()
+            self._settleUntil = _now_ms() + self._IT.get((conf >> 6) & 0xF, 100)
+
+    def onRead(self, reg, n):
+        if _now_ms() >= self._settleUntil:
+            conf = self._conf()
+            gain = self._GAIN[(conf >> 11) & 3]
+            it = self._IT.get((conf >> 6) & 0xF, 100)
+            lux = self.lux * (1 + random.uniform(-0.01, 0.01)) if self.noise else self.lux
+            self._raw = min(0xFFFF, int(lux / (0.0576 * (100/it) / gain)))
+        self.regs[4] = self._raw & 0xFF
+        self.regs[5] = self._raw >> 8
+
+class RGB(Device):
+    def __init__(self, addr=0x08):
+        Device.__init__(self, addr)
+        self.regs[0x00] = 0x84 # Device ID
+        self.regs[0x01:0x03] = b'\x01\x01' # Firmware 1.1
+        self.frames = 0 # LED value writes
+
+    def onWrite(self, reg, value):
+        if reg <= 0x02:
+            return
+        self.regs[reg] = value
+        if reg == 0x07:
+            self.frames += 1
+
+# One simulated bus: devices by address, transaction statistics and wire timing
+class Bus:
+    def __init__(self, freq=400000, delay=True):
+        self.freq = freq
+        self.delay = delay
+        self.devices = {}
+        self.resetStats()
+
+    def add(self, device):
+        self.devices[device.addr] = device
+        return device
+
+    def resetStats(self):
+        self.transactions = 0
+        self.errors = 0
+        self.bytes = 0
+        self.busyMs = 0.0
+        self.perAddr = {}
+
+    def device(self, addr):
+        dev = self.devices.get(addr)
+        if dev is None:
+            self.errors += 1
+            raise OSError(121, 'Remote I/O error') # What Linux reports for a NACK
+        return dev
+
+    # One START..STOP transaction of several messages, each (addr, isRead, data or length)
+    def transfer(self, msgs):
+        t0 = time.perf_counter()
+        self.transactions += 1
+        self.perAddr[msgs[0][0]] = self.perAddr.get(msgs[0][0], 0) + 1
+        nbytes = 0
+        out = []
+        for addr, isRead, payload in msgs:
+            dev = self.device(addr)
+            if isRead:
+                out.append(dev.read(payload))
+                nbytes += 1 + payload
+            else:
+                dev.write(payload)
+                out.append(None)
+                nbytes += 1 + len(payload)
+        self.bytes += nbytes
+        wire = overhead_us/1e6 + (nbytes*9 + 2*len(msgs)) / self.freq # 8 bits + ACK per byte, START and STOP
+        self.busyMs += wire*1000
+        if self.delay: # The real driver blocks, so hold the CPU the same way
+            end = t0 + wire
+            while time.perf_counter() < end:
+                pass
+        return out
+
+_buses = {}
+
+def bus(n=1, **kwargs):
+    if n not in _buses:
+        _buses[n] = Bus(**kwargs)
+    return _buses[n]
+
+# The HomeStation parts, all on bus 1
+def homestation(freq=400000, delay=True, lux=300):
+    b = bus(1)
+    b.freq = freq
+    b.delay = delay
+    b.devices = {}
+    b.add(BME280())
+    b.add(VEML6030(lux=lux))
+    b.add(RGB())
+    b.resetStats()
+    return b
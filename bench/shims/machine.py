@@ -0,0 +1,22 @@
+# Stand-in for MicroPython's machine module - just enough for homestation's status LED
+class Pin:
+    IN = 0
+    OUT = 1
+
+    def __init__(self, id, mode=None, value=None):
+        self.id = id
+        self._value = value or 0
+
+    def on(self):
+        self._value = 1
+
+    def off(self):
+        self._value = 0
+
+    def toggle(self):
+        self._value ^= 1
+
+    def value(self, v=None):
+        if v is None:
+            return self._value
+        self._value = v
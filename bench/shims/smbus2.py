@@ -0,0 +1,48 @@
+# Stand-in for the smbus2 package, backed by the simulated bus in bench/fakei2c.py
+from ctypes import Structure, POINTER, c_char, c_uint16, create_string_buffer, string_at, memmove
+import fakei2c
+
+I2C_M_RD = 0x0001
+
+# Same layout as the kernel's struct i2c_msg, which is what PiicoDev_Unified points at its buffers
+class i2c_msg(Structure):
+    _fields_ = [('addr', c_uint16), ('flags', c_uint16), ('len', c_uint16), ('buf', POINTER(c_char))]
+
+    @staticmethod
+    def read(address, length):
+        return i2c_msg(addr=address, flags=I2C_M_RD, len=length, buf=create_string_buffer(length))
+
+    @staticmethod
+    def write(address, buf):
+        if isinstance(buf, str):
+            buf = buf.encode()
+        buf = bytes(buf)
+        return i2c_msg(addr=address, flags=0, len=len(buf), buf=create_string_buffer(buf, len(buf)))
+
+class SMBus:
+    def __init__(self, bus=None):
+        self.bus = fakei2c.bus(1 if bus is None else bus)
+
+    def i2c_rdwr(self, *msgs):
+        ops = []
+        for m in msgs:
+            if m.flags & I2C_M_RD:
+                ops.append((m.addr, True, m.len))
+            else:
+                ops.append((m.addr, False, string_at(m.buf, m.len)))
+        for m, data in zip(msgs, self.bus.transfer(ops)):
+            if data is not None:
+                memmove(m.buf, data, len(data))
+
+    def write_byte(self, addr, value):
+        self.bus.transfer([(addr, False, bytes((value,)))])
+
+    def write_byte_data(self, addr, reg, value):
+        self.bus.transfer([(addr, False, bytes((reg, value)))])
+
+    def read_word_data(self, addr, reg):
+        data = self.bus.transfer([(addr, False, bytes((reg,))), (addr, True, 2)])[1]
+        return data[0] | data[1] << 8
+
+    def close(self):
+        pass
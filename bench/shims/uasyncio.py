@@ -0,0 +1,5 @@
+# MicroPython's uasyncio on top of CPython's asyncio
+from asyncio import *
+
+def sleep_ms(ms):
+    return sleep(ms/1000)
@@ -30,7 +30,16 @@ Sensor data - input dict
 '''
 
 from machine import Pin
+import uasyncio as asyncio
 import time
+import json
+import struct
+
+import hs_http
+import hs_websocket
+import hs_metrics
+import hs_wifi
+import hs_oled
 
 led = Pin("LED", Pin.OUT, value=1)
 
@@ -41,14 +50,22 @@ try:
 except:
     print('Could not init OLED')
     
+dashboard = None # hs_oled.Dashboard, see oledDashboard()
 if oled:
     display = create_PiicoDev_SSD1306()
-    def showIP(ipStr):
+    dashboard = hs_oled.Dashboard(display)
+    # Without oledDashboard() running nothing else pushes the change, so do it once here
+    async def _pushOnce():
         try:
-            display.text(ipStr, 0,0, 1)
-            display.show()
-        except:
-            print('OLED not plugged in')
+            await dashboard.refresh()
+        except OSError as e: # Unplugged, as in Dashboard.run()
+            print('OLED refresh failed:', e)
+            dashboard.invalidate()
+
+    def showIP(ipStr):
+        dashboard.setLine(0, ipStr)
+        if not dashboard.running:
+            asyncio.create_task(_pushOnce())
         
 def getSensors(sensorDict):
     sensorOut = {}
@@ -59,81 +76,382 @@ def getSensors(sensorDict):
             sensorOut[i] = sensorOut.get('.'+j[0])[j[1]]
     return sensorOut 
 
+sample_interval_sec = 1 # Default poll interval, and the longest the sampler sleeps between checks
+
+# One entry in a SensorRegistry. A sensor reads itself; a group reads several values at once (eg. the BME280)
+# and its fields pick theirs out of the result, so the group is only read once however many fields use it.
+class Sensor:
+    def __init__(self, name, read=None, interval=sample_interval_sec, units='', fmt='{}', group=None, index=None):
+        self.name = name
+        self.read = read
+        self.interval_ms = int(interval*1000)
+        self.units = units
+        self.fmt = fmt
+        self.group = group
+        self.index = index
+        self.lastRead = None # ticks_ms
+
+    def stale(self, now):
+        return self.lastRead is None or time.ticks_diff(now, self.lastRead) >= self.interval_ms
+
+    def msUntilDue(self, now):
+        if self.lastRead is None:
+            return 0
+        return self.interval_ms - time.ticks_diff(now, self.lastRead)
+
+    def format(self, value):
+        if value != value: # NaN from a failed read
+            return '--'
+        return self.fmt.format(value) + self.units
+
+class SensorRegistry:
+    def __init__(self):
+        self.groups = {}
+        self.sensors = [] # Sensors and group fields, in display order
+        self.values = {} # Latest reading per sensor name, updated in place
+        self._groupValues = {}
+
+    def addGroup(self, name, read, interval=sample_interval_sec):
+        self.groups[name] = Sensor(name, read, interval)
+
+    def addSensor(self, name, read, interval=sample_interval_sec, units='', fmt='{}'):
+        self.sensors.append(Sensor(name, read, interval, units, fmt))
+
+    def addField(self, name, group, index, units='', fmt='{}'):
+        self.sensors.append(Sensor(name, units=units, fmt=fmt, group=group, index=index))
+
+    # The old sensor dict: {'.Atmo': atmoSplit, 'Temperature': ['Atmo', 0], 'Light': lght.read}
+    @staticmethod
+    def fromDict(sensorDict, interval=sample_interval_sec):
+        registry = SensorRegistry()
+        for name, entry in sensorDict.items():
+            if name[0] == '.':
+                registry.addGroup(name[1:], entry, interval)
+            elif callable(entry):
+                registry.addSensor(name, entry, interval)
+            elif type(entry) == type([]):
+                registry.addField(name, entry[0], entry[1])
+        return registry
+
+    async def _read(self, sensor):
+        try:
+            value = sensor.read()
+            if hasattr(value, 'send'): # coroutine - let the event loop run while it works
+                value = await value
+        except Exception as e:
+            print('Reading {} failed: {}'.format(sensor.name, e))
+            value = None
+        sensor.lastRead = time.ticks_ms()
+        return value
+
+    # Read every group and sensor whose data is stale, returns True if any value was refreshed
+    async def poll(self):
+        refreshed = False
+        for name, group in self.groups.items():
+            if group.stale(time.ticks_ms()):
+                self._groupValues[name] = await self._read(group)
+                refreshed = True
+        for sensor in self.sensors:
+            if sensor.group is None:
+                if sensor.stale(time.ticks_ms()):
+                    value = await self._read(sensor)
+                    self.values[sensor.name] = float('NaN') if value is None else value
+                    refreshed = True
+            else:
+                groupValue = self._groupValues.get(sensor.group)
+                self.values[sensor.name] = float('NaN') if groupValue is None else groupValue[sensor.index]
+        return refreshed
+
+    def msUntilDue(self):
+        now = time.ticks_ms()
+        due = [s.msUntilDue(now) for s in self.groups.values()] + [s.msUntilDue(now) for s in self.sensors if s.group is None]
+        return max(0, min(due)) if due else int(sample_interval_sec*1000)
+
+    def format(self, name, value):
+        for sensor in self.sensors:
+            if sensor.name == name:
+                return sensor.format(value)
+        return str(value)
+
+sensorRegistry = None # Set by sampleSensors()
+
+# Latest readings, refreshed by sampleSensors() - clients only ever read from here
+sensorSnapshot = {'seq': 0, 'ticks': None, 'time': None, 'readings': None}
+snapshotEvent = asyncio.Event() # Pulsed every time the snapshot is refreshed
+
+# The only task that talks to the sensors, however many clients are connected. Takes a SensorRegistry
+# or an old-style sensor dict, and only reads the sensors that are due.
+async def sampleSensors(sensors, interval=sample_interval_sec):
+    global sensorRegistry
+    if type(sensors) == dict:
+        sensors = SensorRegistry.fromDict(sensors, interval)
+    sensorRegistry = sensors
+    while True:
+        wait = interval
+        try: # One bad pass mustn't end the only task that reads the sensors
+            t0 = time.ticks_us()
+            refreshed = await sensors.poll()
+            hs_metrics.sampleTime.since(t0)
+            if refreshed:
+                sensorSnapshot['readings'] = sensors.values
+                sensorSnapshot['ticks'] = time.ticks_ms()
+                sensorSnapshot['time'] = int(time.time())
+                logReadings(sensorSnapshot['time'], sensorSnapshot['readings'])
+                sensorSnapshot['seq'] += 1
+                snapshotEvent.set() # Wake every /events stream, then re-arm for the next sample
+                snapshotEvent.clear()
+            wait = min(sensors.msUntilDue(), int(interval*1000))/1000
+        except Exception as e:
+            hs_metrics.sampleErrors.inc()
+            print('Sampling failed:', e)
+        await asyncio.sleep(wait)
+
+sensorLog = None # hs_flashlog.FlashLog with one field per numeric reading, see setSensorLog()
+log_interval_sec = 60
+_lastLogged = None
+
+# Persist the numeric readings (sensor dict order) once per interval, read back at /log?from=&to=
+def setSensorLog(log, interval=60):
+    global sensorLog, log_interval_sec
+    sensorLog = log
+    log_interval_sec = interval
+
+def logReadings(t, readings):
+    global _lastLogged
+    if not hs_wifi.clockSet: # Timestamps would restart from the same value every boot
+        return
+    if sensorLog is None or (_lastLogged is not None and t - _lastLogged < log_interval_sec):
+        return
+    _lastLogged = t
+    try:
+        sensorLog.append(t, [value for _, value in numericReadings(readings)])
+    except Exception as e: # Flash full or gone - keep sampling regardless
+        print('Sensor log write failed:', e)
+
+def htmlifySensors(readings):
+    if readings is None:
+        return '<p>Getting sensor state...</p>'
+    sensStr = ''
+    for name, value in readings.items():
+        if name[0] == '.': # Group reads are only there to feed the other entries
+            continue
+        if sensorRegistry is not None:
+            value = sensorRegistry.format(name, value)
+        sensStr += '<p>{} {}</p>'.format(name, value)
+    return sensStr
+
+
+def _oledLine(name, value):
+    if sensorRegistry is not None:
+        for sensor in sensorRegistry.sensors:
+            if sensor.name == name:
+                value = '--' if value != value else sensor.fmt.format(value) # Units are HTML, leave them off
+                break
+    return '{:<8}{:>8}'.format(name.rstrip(':')[:8], str(value)[:8])
+
+# Status and one line per reading on the OLED, updated on every sample and at least once a second.
+# Only the characters that changed go over the bus. Does nothing without a display.
+async def oledDashboard():
+    if dashboard is None:
+        return
+    asyncio.create_task(dashboard.run())
+    while True:
+        if wifi is not None:
+            dashboard.setLine(0, wifi.ip if wifi.state == hs_wifi.CONNECTED else 'WiFi ' + hs_wifi.STATE_NAMES[wifi.state])
+        readings = sensorSnapshot['readings']
+        if readings is not None:
+            row = 2
+            for name, value in readings.items():
+                if name[0] == '.' or row >= dashboard.pages-1:
+                    continue
+                dashboard.setLine(row, _oledLine(name, value))
+                row += 1
+        dashboard.setLine(dashboard.pages-1, 'Clients {}'.format(hs_metrics.activeConnections.value))
+        try:
+            await asyncio.wait_for(snapshotEvent.wait(), 1)
+        except asyncio.TimeoutError:
+            pass
+
+# Numeric readings in sensor dict order, group reads ('.Atmo' etc) are left out
+def numericReadings(readings):
+    values = []
+    for name, value in readings.items():
+        if name[0] != '.' and type(value) in (int, float):
+            values.append((name, value))
+    return values
+
+# Machine-readable snapshot for collectors, encoded once per sample however many clients ask.
+# /api/sensors.bin layout (little endian): uint32 time [s], then one float32 per numeric reading in sensor dict order
+_apiCache = {'seq': -1, 'api': None}
+
+def apiSensors():
+    if sensorSnapshot['readings'] is None:
+        return None
+    if _apiCache['seq'] != sensorSnapshot['seq']:
+        t = sensorSnapshot['time']
+        values = numericReadings(sensorSnapshot['readings'])
+        apiDict = {'time': t}
+        for name, value in values:
+            apiDict[name] = value if value == value else None # NaN isn't valid JSON
+        apiBin = struct.pack('<I' + 'f'*len(values), t, *[v for _, v in values])
+        _apiCache['api'] = (json.dumps(apiDict).encode(), apiBin)
+        _apiCache['seq'] = sensorSnapshot['seq']
+    return _apiCache['api']
+
+# The /events payload, encoded once per sample however many streams are open
+_eventCache = {'seq': -1, 'data': None}
+
+def sensorEvent():
+    if _eventCache['seq'] != sensorSnapshot['seq']:
+        _eventCache['data'] = ('data: ' + htmlifySensors(sensorSnapshot['readings']) + '\n\n').encode()
+        _eventCache['seq'] = sensorSnapshot['seq']
+    return _eventCache['data']
 
 
 # def buildSensorHTML():
 #     
     
 
-def blink_led(frequency = 0.5, num_blinks = 3):
-    for _ in range(num_blinks):
-        led.on()
-        time.sleep(frequency)
-        led.off()
-        time.sleep(frequency)
-    
-    
+# The index page only depends on the template strings, so render it once and serve the cached bytes
+_indexPage = None
+
+def indexPage():
+    global _indexPage
+    if _indexPage is None:
+        _indexPage = hs_http.CachedPage(html.format(script=script,colour=colour))
+    return _indexPage
+
+# Call after changing html, colour or script
+def invalidateIndex():
+    global _indexPage
+    _indexPage = None
+
 def requestBreakdown(request):
     return request.split()
 
+lightHandler = None # Called with [R,G,B] when the colour picker changes
+
+def setLightHandler(handler):
+    global lightHandler
+    lightHandler = handler
+
+# Binary WebSocket colour command: 3 bytes R G B
+def wsLight(payload):
+    if len(payload) >= 3 and lightHandler is not None:
+        lightHandler([payload[0],payload[1],payload[2]])
+
 def strToLight(a):
     hex_pref = '0x'
     return [int(hex_pref+a[0:2]),int(hex_pref+a[2:4]),int(hex_pref+a[4:6])]
 
+wifi = None # hs_wifi.WiFi supervisor, once connect_to_wifi() has started
+
+def _wifiUp(ip):
+    if dashboard is not None:
+        showIP(ip)
+
+# Bring WiFi up and keep it up: retries with backoff and reconnects after drops, without blocking the
+# webserver. Also runs the status LED. Never returns, so start it with asyncio.create_task().
 async def connect_to_wifi(wlan_param):
+    global wifi
     wlan, ssid, passw = wlan_param
-    wlan.active(True)
-    wlan.config(pm = 0xa11140)  # Diable powersave mode
-    wlan.connect(ssid, passw)
-    
-    # Wait for connect or fail
-    max_wait = 10
-    while max_wait > 0:
-        if wlan.status() < 0 or wlan.status() >= 3:
-            break
-        max_wait -= 1
-        print('Waiting for connection...')
-        time.sleep(1)
-
-    # Handle connection error
-    if wlan.status() != 3:
-        blink_led(0.1, 10)
-        raise RuntimeError('WiFi connection failed')
+    wifi = hs_wifi.WiFi(wlan, ssid, passw, onConnect=_wifiUp)
+    asyncio.create_task(hs_wifi.statusLed(led, wifi))
+    await wifi.run()
+
+# Route handlers, called as handler(req, writer, keepAlive). See hs_http.Router.
+def _sensorHTML(req):
+    if req.sensors is None:
+        return htmlifySensors(sensorSnapshot['readings'])
+    if type(req.sensors) != str: # eg. a dict of readings, shown as it always was
+        return '<p>{}</p>'.format(req.sensors)
+    return req.sensors
+
+def _serveIndex(req, writer, keepAlive): #Make 2 standard ones and the option to add more easily
+    indexPage().send(writer, req, keepAlive=keepAlive)
+
+def _serveSensors(req, writer, keepAlive):
+    hs_http.sendResponse(writer, _sensorHTML(req), keepAlive=keepAlive)
+
+def _serveApi(req, writer, keepAlive):
+    api = apiSensors()
+    if api is None:
+        hs_http.sendResponse(writer, 'No readings yet', ctype='text/plain', status='503 Service Unavailable', keepAlive=keepAlive)
+    elif req.pathIs(b'/api/sensors'):
+        hs_http.sendResponse(writer, api[0], ctype='application/json', keepAlive=keepAlive)
     else:
-        blink_led(0.5, 2)
-        print('Connected')
-        status = wlan.ifconfig()
-        print('IP = ' + status[0])
-        showIP(status[0])
-
+        hs_http.sendResponse(writer, api[1], ctype='application/octet-stream', keepAlive=keepAlive)
+
+def _serveLog(req, writer, keepAlive):
+    if sensorLog is None:
+        hs_http.sendError(writer, 404, keepAlive=keepAlive)
+        return
+    try:
+        t0 = req.queryInt(b'from', 0)
+        t1 = req.queryInt(b'to', int(time.time()))
+    except ValueError:
+        hs_http.sendResponse(writer, 'from and to must be whole seconds', ctype='text/plain', status='400 Bad Request', keepAlive=keepAlive)
+    else:
+        hs_http.sendResponse(writer, sensorLog.read(t0, t1), ctype='application/octet-stream', keepAlive=keepAlive,
+                             headers='X-Record-Format: {}\r\n'.format(sensorLog.fmt))
+
+async def _serveEvents(req, writer, keepAlive):
+    if not hs_http.startStream(req):
+        hs_http.sendError(writer, hs_http.UNAVAILABLE, keepAlive=keepAlive, headers='Retry-After: 10\r\n')
+        return False
+    writer.write(b'HTTP/1.0 200 OK\r\nContent-type: text/event-stream\r\nCache-Control: no-cache\r\n\r\n')
+    await hs_http.streamEvents(writer, snapshotEvent, sensorEvent)
+    return True
+
+def _serveLedSet(req, writer, keepAlive):
+    try:
+        lightOut = strToLight(req.query(b'state', ''))
+    except (ValueError, IndexError):
+        hs_http.sendResponse(writer, 'state must be RRGGBB hex', ctype='text/plain', status='400 Bad Request', keepAlive=keepAlive)
+        return
+    if lightHandler is not None:
+        lightHandler(lightOut)
+    hs_http.sendResponse(writer, keepAlive=keepAlive)
+
+async def _serveWebSocket(req, writer, keepAlive):
+    wsKey = req.get(b'sec-websocket-key')
+    if wsKey is None:
+        hs_http.sendError(writer, 404, keepAlive=keepAlive)
+        return False
+    if not hs_http.startStream(req):
+        hs_http.sendError(writer, hs_http.UNAVAILABLE, keepAlive=keepAlive, headers='Retry-After: 10\r\n')
+        return False
+    if req.query(b'sensors') == '1': # Optionally push the sensors down the same socket
+        await hs_websocket.serve(req.reader, writer, wsKey, wsLight, snapshotEvent, lambda: htmlifySensors(sensorSnapshot['readings']))
+    else:
+        await hs_websocket.serve(req.reader, writer, wsKey, wsLight)
+    return True
+
+def _serveMetrics(req, writer, keepAlive):
+    hs_http.sendResponse(writer, hs_metrics.render(), ctype='text/plain; version=0.0.4', keepAlive=keepAlive)
+
+routes = hs_http.Router()
+routes.add('/', _serveIndex)
+routes.add('/sensors', _serveSensors)
+routes.add('/api/sensors', _serveApi)
+routes.add('/api/sensors.bin', _serveApi)
+routes.add('/log', _serveLog)
+routes.add('/events', _serveEvents)
+routes.add('/led_set', _serveLedSet)
+routes.add('/ws', _serveWebSocket)
+routes.add('/metrics', _serveMetrics)
+
+# Add or replace an endpoint. handler(req, writer, keepAlive) gets an hs_http.Request and must write a
+# whole response (hs_http.sendResponse), or return True if it has taken the connection over.
+# With prefix=True every path starting with `path` goes to handler.
+def addRoute(path, handler, prefix=False):
+    routes.add(path, handler, prefix)
+
+# Pass to asyncio.start_server(). sensors, if given, is answered at /sensors instead of the live readings:
+# a str as HTML, anything else (eg. a dict) as <p>str(sensors)</p>.
 async def serve_client(reader, writer, sensors=None):
-    print(type(sensors))
-    print("Client connected")
-    request_line = await reader.readline()
-    print("Request:", request_line)
-    # We are not interested in HTTP request headers, skip them
-    while await reader.readline() != b"\r\n":
-        pass
-    request = str(request_line)
-    cmd_rq = requestBreakdown(request)
-    
-    if cmd_rq[1] == '/': #Make 2 standard ones and the option to add more easily
-        writer.write('HTTP/1.0 200 OK\r\nContent-type: text/html\r\n\r\n')
-        response = html.format(sensors=sensors,script=script,colour=colour)
-        #pushLight(leds,[[0,0,0]]*3)
-        writer.write(response)
-        
-    elif cmd_rq[1] == '/sensors':
-        sensorUpdateStr = '<p>{}</p>'.format(sensors) ######################################################## Change to a dict input, somehow tie it to the top side functions
-        writer.write(sensorUpdateStr)
-
-    elif cmd_rq[1][:15] == '/led_set?state=':
-        lightOut = strToLight(cmd_rq[1][15:])
-        #pushLight(leds,[lightOut]*3)
+    await hs_http.serve(reader, writer, routes, sensors)
 
-    await writer.drain()
-    await writer.wait_closed()
-    print("Client disconnected")
     
 
 
@@ -174,6 +492,7 @@ colour = '''
 
 script = '''<script>
 let colorWell;
+let colourSocket = null;
 const defaultColor = "#000000";
 window.addEventListener("load", startup, false);
 function startup() {
@@ -181,8 +500,17 @@ function startup() {
     colorWell.value = defaultColor;
     colorWell.addEventListener("input", updateFirst, false);
     colorWell.select();
+    if (!!window.WebSocket) {
+        colourSocket = new WebSocket("ws://" + location.host + "/ws");
+        colourSocket.binaryType = "arraybuffer";
+    }
 }
 function updateFirst(event) {
+    if (colourSocket && colourSocket.readyState == 1) {
+        var rgb = parseInt(String(event.target.value).substr(1), 16);
+        colourSocket.send(new Uint8Array([rgb >> 16, (rgb >> 8) & 255, rgb & 255]));
+        return;
+    }
     var xhttp = new XMLHttpRequest();
     xhttp.onreadystatechange = function() {
     if (this.readyState == 4 && this.status == 200) {
@@ -192,9 +520,27 @@ function updateFirst(event) {
     xhttp.open("GET", "led_set?state=" + String(event.target.value).substr(1), true);
     xhttp.send();
 }
-setInterval(function() {
-  getSensors();
-}, 500);
+var sensorPoll = null;
+function pollSensors() {
+  if (sensorPoll == null) {
+    sensorPoll = setInterval(function() {
+      getSensors();
+    }, 500);
+  }
+}
+if (!!window.EventSource) {
+  var sensorSource = new EventSource("events");
+  sensorSource.onmessage = function(event) {
+    document.getElementById("sensors").innerHTML = event.data;
+  };
+  sensorSource.onerror = function() {
+    if (sensorSource.readyState == 2) { // Refused (eg. 503 when the server is full), browsers don't retry that
+      pollSensors();
+    }
+  };
+} else {
+  pollSensors();
+}
 function getSensors() {
   var xhttp = new XMLHttpRequest();
   xhttp.onreadystatechange = function() {
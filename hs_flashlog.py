@@ -0,0 +1,162 @@
+'''
+HomeStation flash logger
+Append-only log of fixed-size binary records (uint32 time [s] + one float32 per field) that survives reboots
+and WiFi outages. Records are buffered in RAM and written a page at a time, so the flash sees a few large
+appends instead of a write per sample. The log is split into numbered segment files; when there are more than
+maxSegments the oldest file is deleted, so nothing is ever rewritten in place.
+
+Segments are kept in time order, so finding a timestamp is a bisect over the (tiny) segment index and then a
+bisect over the fixed-size records in one file. This assumes the wall clock only moves forwards (hs_wifi sets it
+from NTP, and nothing is logged before that) - if it jumps back a new segment is started, so each segment on
+its own is always in order.
+'''
+
+import os
+import struct
+
+class FlashLog:
+    def __init__(self, nfields, directory='log', segmentRecords=4096, maxSegments=8, pageSize=4096, flushAfter=600):
+        self.fmt = '<I' + 'f'*nfields
+        self.recSize = struct.calcsize(self.fmt)
+        self.directory = directory
+        self.segmentRecords = segmentRecords
+        self.maxSegments = maxSegments
+        self.flushAfter = flushAfter # [s] flush a part-full page if its oldest record is this old
+        self._buf = bytearray((pageSize // self.recSize) * self.recSize)
+        self._used = 0
+        self._lastT = None
+        self._torn = False # A write failed part way, so the last segment may end in a partial record
+        try:
+            os.mkdir(directory)
+        except OSError: # Already there
+            pass
+        # Index of [segment number, first timestamp, record count], oldest first
+        self.index = []
+        for name in sorted(os.listdir(directory)):
+            if name[-4:] == '.bin':
+                seg = int(name[:-4])
+                size = os.stat(self._path(seg))[6]
+                n = size // self.recSize
+                if n:
+                    self.index.append([seg, self._readRecord(seg, 0)[0], n])
+                    # Power cut mid-flush: only the whole records count, and appending after the partial one
+                    # would misalign everything after it, so the next flush goes to a new segment
+                    self._torn = size % self.recSize != 0
+                else: # Nothing whole in it
+                    self._remove(seg)
+        if self.index:
+            seg, first, n = self.index[-1]
+            self._lastT = self._readRecord(seg, n-1)[0]
+
+    def _path(self, seg):
+        return '{}/{:08d}.bin'.format(self.directory, seg)
+
+    def _readRecord(self, seg, n):
+        with open(self._path(seg), 'rb') as f:
+            f.seek(n*self.recSize)
+            return struct.unpack(self.fmt, f.read(self.recSize))
+
+    def append(self, t, values):
+        if self._lastT is not None and t < self._lastT: # Clock went backwards - keep each segment in order
+            self.flush()
+            if self.index and self.index[-1][2]:
+                self._newSegment()
+        struct.pack_into(self.fmt, self._buf, self._used, t, *values)
+        self._used += self.recSize
+        self._lastT = t
+        if self._used == len(self._buf) or t - self._bufferedSince() >= self.flushAfter:
+            self.flush()
+
+    def _bufferedSince(self):
+        return struct.unpack_from('<I', self._buf, 0)[0]
+
+    def _newSegment(self):
+        seg = self.index[-1][0]+1 if self.index else 0
+        self.index.append([seg, None, 0])
+        while len(self.index) > self.maxSegments: # Rotate out the oldest segment
+            self._remove(self.index.pop(0)[0])
+
+    def _remove(self, seg):
+        try:
+            os.remove(self._path(seg))
+        except OSError: # Never written
+            pass
+
+    # Write the RAM buffer out, splitting it across segments as they fill. If the write fails (flash full)
+    # the buffered records are dropped and the error raised, and the next flush starts a new segment.
+    def flush(self):
+        done = 0
+        try:
+            while done < self._used:
+                if self._torn and self.index and not self.index[-1][2]: # Nothing whole in it, start it again
+                    self._remove(self.index[-1][0])
+                    self.index[-1][1] = None
+                elif not self.index or self.index[-1][2] >= self.segmentRecords or self._torn:
+                    self._newSegment()
+                self._torn = False
+                entry = self.index[-1]
+                n = min((self._used - done) // self.recSize, self.segmentRecords - entry[2])
+                if entry[1] is None:
+                    entry[1] = struct.unpack_from('<I', self._buf, done)[0]
+                with open(self._path(entry[0]), 'ab') as f:
+                    f.write(memoryview(self._buf)[done:done + n*self.recSize])
+                entry[2] += n
+                done += n*self.recSize
+        except OSError:
+            self._torn = True
+            raise
+        finally:
+            self._used = 0 # Written or lost, the buffer is free for new records either way
+
+    # First record in seg at or after t
+    def _seek(self, seg, n, t):
+        lo, hi = 0, n
+        with open(self._path(seg), 'rb') as f:
+            while lo < hi:
+                mid = (lo+hi)//2
+                f.seek(mid*self.recSize)
+                if struct.unpack('<I', f.read(4))[0] < t:
+                    lo = mid+1
+                else:
+                    hi = mid
+        return lo
+
+    # Raw records with t0 <= time <= t1, flushed and still buffered, at most maxRecords of them. The records are
+    # counted first (a bisect per segment), so the result is allocated once and read straight into.
+    def read(self, t0, t1, maxRecords=1000):
+        spans = [] # (segment, first record, records)
+        count = 0
+        for i in range(len(self.index)):
+            seg, first, n = self.index[i]
+            if count == maxRecords:
+                break
+            if first is None or first > t1:
+                continue
+            if i+1 < len(self.index) and self.index[i+1][1] is not None and self.index[i+1][1] <= t0 and self.index[i+1][1] >= first:
+                continue # Everything wanted starts in a later segment
+            start = self._seek(seg, n, t0)
+            k = min(self._seek(seg, n, t1+1) - start, maxRecords - count)
+            if k > 0:
+                spans.append((seg, start, k))
+                count += k
+        for pos in range(0, self._used, self.recSize):
+            if count == maxRecords:
+                break
+            if t0 <= struct.unpack_from('<I', self._buf, pos)[0] <= t1:
+                count += 1
+        out = bytearray(count*self.recSize)
+        mv = memoryview(out)
+        done = 0
+        for seg, start, k in spans:
+            with open(self._path(seg), 'rb') as f:
+                f.seek(start*self.recSize)
+                f.readinto(mv[done:done + k*self.recSize])
+            done += k*self.recSize
+        buf = memoryview(self._buf)
+        for pos in range(0, self._used, self.recSize):
+            if done == len(out):
+                break
+            if t0 <= struct.unpack_from('<I', self._buf, pos)[0] <= t1:
+                mv[done:done+self.recSize] = buf[pos:pos+self.recSize]
+                done += self.recSize
+        return out
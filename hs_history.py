@@ -0,0 +1,172 @@
+'''
+HomeStation sensor history
+Fixed-memory ring buffers backed by array, so readings never become individual float objects on the heap
+and nothing grows or fragments over time. Keeps raw readings plus 1-min and 15-min min/mean/max rollups,
+and downsamples on the device for the /history endpoint.
+'''
+
+from array import array
+import json
+
+NaN = float('nan')
+max_points = 200 # Rows returned by one query, step is raised to fit
+
+# Each slot is a uint32 timestamp [s] and `width` float32 values, oldest entries are overwritten
+class RingBuffer:
+    def __init__(self, capacity, width):
+        self.capacity = capacity
+        self.width = width
+        self.times = array('I', [0]*capacity)
+        self.data = array('f', [0]*(capacity*width))
+        self.head = 0 # Next slot to write
+        self.count = 0
+
+    def append(self, t, values):
+        i = self.head
+        self.times[i] = t
+        base = i*self.width
+        for j in range(self.width):
+            self.data[base+j] = values[j]
+        self.head = (i+1) % self.capacity
+        if self.count < self.capacity:
+            self.count += 1
+
+    # Physical slot of the n-th oldest entry
+    def slot(self, n):
+        return (self.head - self.count + n) % self.capacity
+
+    def oldest(self):
+        if self.count == 0:
+            return None
+        return self.times[self.slot(0)]
+
+    # Slots of the entries at or after `since`, oldest first. Timestamps only ever increase, so bisect.
+    def slotsSince(self, since):
+        lo, hi = 0, self.count
+        while lo < hi:
+            mid = (lo+hi)//2
+            if self.times[self.slot(mid)] < since:
+                lo = mid+1
+            else:
+                hi = mid
+        for n in range(lo, self.count):
+            yield self.slot(n)
+
+# Accumulates readings into `period` second buckets and stores min, mean, max per field when a bucket closes
+class Rollup:
+    def __init__(self, period, capacity, nfields):
+        self.period = period
+        self.nfields = nfields
+        self.buf = RingBuffer(capacity, 3*nfields)
+        self._start = None
+        self._min = array('f', [0]*nfields)
+        self._max = array('f', [0]*nfields)
+        self._sum = array('f', [0]*nfields)
+        self._n = array('H', [0]*nfields)
+        self._out = array('f', [0]*(3*nfields))
+
+    def _reset(self, start):
+        self._start = start
+        for j in range(self.nfields):
+            self._n[j] = 0
+            self._sum[j] = 0
+
+    def add(self, t, values):
+        start = t - t % self.period
+        if start != self._start:
+            if self._start is not None:
+                self.flush()
+            self._reset(start)
+        for j in range(self.nfields):
+            v = values[j]
+            if v != v: # Skip NaN from a failed read
+                continue
+            if self._n[j] == 0 or v < self._min[j]:
+                self._min[j] = v
+            if self._n[j] == 0 or v > self._max[j]:
+                self._max[j] = v
+            self._sum[j] += v
+            self._n[j] += 1
+
+    def flush(self):
+        out = self._out
+        for j in range(self.nfields):
+            n = self._n[j]
+            out[3*j] = self._min[j] if n else NaN
+            out[3*j+1] = self._sum[j]/n if n else NaN
+            out[3*j+2] = self._max[j] if n else NaN
+        self.buf.append(self._start, out)
+
+class History:
+    def __init__(self, fields, rawCapacity=300, rollups=((60, 240), (900, 192))):
+        self.fields = fields
+        self.raw = RingBuffer(rawCapacity, len(fields))
+        self.rollups = [Rollup(period, capacity, len(fields)) for period, capacity in rollups]
+
+    def add(self, t, values):
+        self.raw.append(t, values)
+        for rollup in self.rollups:
+            rollup.add(t, values)
+
+    # Finest tier that reaches back to `since`, else the one that reaches furthest
+    def _tier(self, since):
+        best = (0, self.raw)
+        for period, buf in [(0, self.raw)] + [(rollup.period, rollup.buf) for rollup in self.rollups]:
+            oldest = buf.oldest()
+            if oldest is None:
+                continue
+            if oldest <= since:
+                return (period, buf)
+            bestOldest = best[1].oldest()
+            if bestOldest is None or oldest < bestOldest:
+                best = (period, buf)
+        return best
+
+    # Downsample the last rangeSec seconds into step second rows of [t, min, mean, max, min, mean, max, ...]
+    def query(self, now, rangeSec, step):
+        if rangeSec // step > max_points:
+            step = -(-rangeSec // max_points)
+        since = now - rangeSec
+        period, buf = self._tier(since)
+        nfields = len(self.fields)
+        rows = []
+        row = None
+        for i in buf.slotsSince(since):
+            t = buf.times[i]
+            bucket = t - t % step
+            if row is None or row[0] != bucket:
+                if row is not None:
+                    rows.append(_finishRow(row, nfields))
+                row = [bucket] + [None, 0, None, 0]*nfields # min, sum, max, n per field
+            base = i*buf.width
+            for j in range(nfields):
+                if period:
+                    lo, mean, hi = buf.data[base+3*j], buf.data[base+3*j+1], buf.data[base+3*j+2]
+                else:
+                    lo = mean = hi = buf.data[base+j]
+                if mean != mean:
+                    continue
+                k = 1+4*j
+                if row[k] is None or lo < row[k]:
+                    row[k] = lo
+                row[k+1] += mean
+                if row[k+2] is None or hi > row[k+2]:
+                    row[k+2] = hi
+                row[k+3] += 1
+        if row is not None:
+            rows.append(_finishRow(row, nfields))
+        return step, rows
+
+    def toJSON(self, now, rangeSec, step):
+        step, rows = self.query(now, rangeSec, step)
+        return json.dumps({'fields': self.fields, 'step': step, 'rows': rows})
+
+def _finishRow(row, nfields):
+    out = [row[0]]
+    for j in range(nfields):
+        k = 1+4*j
+        n = row[k+3]
+        out.append(row[k])
+        out.append(row[k+1]/n if n else None)
+        out.append(row[k+2])
+    return out
@@ -0,0 +1,659 @@
+'''
+HomeStation HTTP helpers
+Request reading and response writing for persistent (HTTP/1.1 keep-alive) connections, so a polling
+browser reuses one socket instead of paying a TCP handshake on the CYW43 radio for every request.
+Pipelined requests just queue up in the stream reader and are answered in order.
+
+Every connection is bounded: only max_connections are served at once (a few more queue briefly, the rest get
+503), headers have to arrive within a deadline and fit in max_header_bytes, and a client that stops reading
+is dropped when drain() misses its deadline, so a stalled browser or a burst of tabs costs a bounded amount of
+heap and sockets instead of wedging the device.
+
+serve() runs a whole connection, pass it to asyncio.start_server() with a Router:
+    asyncio.start_server(lambda r, w: hs_http.serve(r, w, routes), "0.0.0.0", 80)
+'''
+
+import uasyncio as asyncio
+import hashlib
+import binascii
+import io
+import time
+import hs_metrics
+try:
+    import deflate # MicroPython 1.21+
+except ImportError:
+    deflate = None
+
+idle_timeout_sec = 5 # Close a kept-alive connection if the next request doesn't start within this
+max_requests = 100 # Requests served on one connection before it is closed, so no client can hog a socket
+
+max_header_bytes = 2048 # Request line and headers must fit in this, or the request is refused with 431
+max_headers = 32 # Header lines per request, more is refused with 431
+header_timeout_sec = 2 # Request line and headers must all arrive within this of the first byte, or 408
+max_body_bytes = 1024 # The endpoints take no body, one up to this size is read and discarded, bigger is 413
+body_timeout_sec = 2 # for the body to arrive
+write_timeout_sec = 5 # Drop a client that hasn't taken a response (or SSE update) within this
+
+max_connections = 4 # Connections served at once, each holds a socket and a Request buffer
+max_queued = 4 # Further connections wait up to queue_timeout_sec for a slot, beyond that they get 503 at once
+queue_timeout_sec = 2
+# /events and WebSocket connections held open, counted apart so they can't lock out requests. Every open page
+# uses two (one of each), so this is 4 tabs; each costs a socket and a Request buffer. Pages that are turned
+# away fall back to polling /sensors.
+max_streams = 8
+heartbeat_sec = 15 # Comment sent on an /events stream with nothing new, so a client that silently went away is noticed
+
+OK = 0
+BAD_REQUEST = 400
+TIMEOUT = 408
+LENGTH_REQUIRED = 411
+BODY_TOO_LARGE = 413
+TOO_LARGE = 431
+UNAVAILABLE = 503
+
+if hasattr(bytearray, 'find'):
+    def _find(buf, sub, start, end):
+        return buf.find(sub, start, end)
+else: # MicroPython's bytearray has no find()
+    def _find(buf, sub, start, end):
+        n = len(sub)
+        first = sub[0]
+        i = start
+        last = end - n
+        while i <= last:
+            if buf[i] == first:
+                j = 1
+                while j < n and buf[i+j] == sub[j]:
+                    j += 1
+                if j == n:
+                    return i
+            i += 1
+        return -1
+
+# One connection's requests, parsed in place in a preallocated buffer. Nothing is copied out of the buffer
+# unless a handler asks for it (path(), get(), query()), so routing a request creates no garbage.
+# Bytes after the end of the headers are kept for the next read(), so pipelined requests work.
+class Request:
+    def __init__(self, size=max_header_bytes):
+        self.buf = bytearray(size)
+        self._mv = memoryview(self.buf)
+        self._len = 0 # Bytes in buf
+        self._end = 0 # End of the current request's headers
+        self._skip = 0 # Body bytes of the previous request still to discard
+        self.reader = None
+        self.sensors = None # Whatever serve() was given, homestation uses it for static sensor HTML
+        self.streaming = False # Holds a stream slot rather than a connection slot, see startStream()
+        self._clear()
+
+    def _clear(self):
+        self._ms = self._me = self._ps = self._pe = self._qs = self._qe = 0
+        self._vs = self._ve = self._hs = self._he = 0
+
+    # Bytes read, 0 at end of stream, or None if nothing arrived within timeout [s]
+    async def _fill(self, reader, timeout):
+        if timeout <= 0:
+            return None
+        space = self._mv[self._len:]
+        try:
+            if hasattr(reader, 'readinto'): # MicroPython
+                n = await asyncio.wait_for(reader.readinto(space), timeout)
+            else:
+                data = await asyncio.wait_for(reader.read(len(space)), timeout)
+                n = len(data)
+                space[:n] = data
+        except asyncio.TimeoutError:
+            return None
+        self._len += n
+        return n
+
+    # Throw away the previous request's body. False if the client closed or was too slow sending it.
+    async def _skipBody(self, reader):
+        deadline = time.ticks_add(time.ticks_ms(), int(body_timeout_sec*1000))
+        while self._skip:
+            if not self._len:
+                n = await self._fill(reader, _remaining(deadline))
+                if not n:
+                    if n is None:
+                        hs_metrics.timeouts.inc()
+                    return False
+            n = min(self._skip, self._len)
+            if n < self._len:
+                self.buf[:self._len-n] = self._mv[n:self._len]
+            self._len -= n
+            self._skip -= n
+        return True
+
+    # Read and parse the next request. Returns None if the client closed the connection, went idle or
+    # stalled in a body, otherwise OK or an error status to send - malformed input never raises.
+    async def read(self, reader, timeout=idle_timeout_sec):
+        self.reader = reader
+        if self._end: # Move any pipelined bytes to the front
+            rest = self._len - self._end
+            if rest:
+                self.buf[:rest] = self._mv[self._end:self._len]
+            self._len = rest
+            self._end = 0
+        if self._skip and not await self._skipBody(reader):
+            return None
+        scanned = 0
+        t0 = deadline = None # Header read time and deadline run from the first byte
+        if self._len:
+            t0 = time.ticks_us()
+            deadline = time.ticks_add(time.ticks_ms(), int(header_timeout_sec*1000))
+        while True:
+            end = _find(self.buf, b'\r\n\r\n', scanned, self._len)
+            if end >= 0:
+                break
+            scanned = max(0, self._len - 3)
+            if self._len == len(self.buf):
+                self._len = 0
+                return TOO_LARGE
+            n = await self._fill(reader, timeout if t0 is None else _remaining(deadline))
+            if n is None and t0 is not None: # Started a request but stalled
+                hs_metrics.timeouts.inc()
+                self._len = 0
+                return TIMEOUT
+            if not n:
+                return None
+            if t0 is None:
+                t0 = time.ticks_us()
+                deadline = time.ticks_add(time.ticks_ms(), int(header_timeout_sec*1000))
+        self._end = end + 4
+        status = self._parse(end)
+        if status == OK:
+            status = self._body()
+        hs_metrics.headerTime.since(t0)
+        return status
+
+    # Queue the body (if any) to be discarded before the next request
+    def _body(self):
+        if self._header(b'transfer-encoding') is not None: # Chunked, length unknown
+            return LENGTH_REQUIRED
+        span = self._header(b'content-length')
+        if span is None:
+            return OK
+        n = 0
+        for i in range(span[0], span[1]):
+            d = self.buf[i] - 0x30
+            if not 0 <= d <= 9:
+                return BAD_REQUEST
+            n = n*10 + d
+            if n > max_body_bytes:
+                return BODY_TOO_LARGE
+        if span[0] == span[1]:
+            return BAD_REQUEST
+        self._skip = n
+        return OK
+
+    def _parse(self, end):
+        buf = self.buf
+        lineEnd = _find(buf, b'\r\n', 0, end+2)
+        sp1 = _find(buf, b' ', 0, lineEnd)
+        sp2 = _find(buf, b' ', sp1+1, lineEnd) if sp1 > 0 else -1
+        if sp2 < 0 or sp2 == sp1+1 or _find(buf, b' ', sp2+1, lineEnd) >= 0 or buf[sp1+1] != 0x2F: # Not "METHOD /target VERSION"
+            self._clear()
+            return BAD_REQUEST
+        self._ms = 0
+        self._me = sp1
+        self._ps = sp1+1
+        q = _find(buf, b'?', sp1+1, sp2)
+        if q < 0:
+            self._pe = self._qs = self._qe = sp2
+        else:
+            self._pe = q
+            self._qs = q+1
+            self._qe = sp2
+        self._vs = sp2+1
+        self._ve = lineEnd
+        self._hs = lineEnd+2 # Header lines, each ending in CRLF
+        self._he = end+2
+        lines = 0
+        pos = self._hs
+        while pos < self._he:
+            lines += 1
+            if lines > max_headers:
+                return TOO_LARGE
+            pos = _find(buf, b'\r\n', pos, self._he) + 2
+        return OK
+
+    def _is(self, s, e, value):
+        return e - s == len(value) and _find(self.buf, value, s, e) == s
+
+    def isMethod(self, method):
+        return self._is(self._ms, self._me, method)
+
+    def method(self):
+        return bytes(self._mv[self._ms:self._me]).decode()
+
+    # Path without the query string
+    def path(self):
+        return bytes(self._mv[self._ps:self._pe]).decode()
+
+    def pathIs(self, path):
+        return self._is(self._ps, self._pe, path)
+
+    def pathStartsWith(self, prefix):
+        return self._pe - self._ps >= len(prefix) and _find(self.buf, prefix, self._ps, self._ps+len(prefix)) == self._ps
+
+    # HTTP/1.1 defaults to a persistent connection, HTTP/1.0 has to ask for one
+    def keepAlive(self):
+        if self._is(self._vs, self._ve, b'HTTP/1.1'):
+            return not self._headerHasLower(b'connection', b'close')
+        return self._headerHasLower(b'connection', b'keep-alive')
+
+    # (start, end) of the value of header `name` (lowercase bytes), or None
+    def _header(self, name):
+        buf = self.buf
+        pos = self._hs
+        n = len(name)
+        while pos < self._he:
+            eol = _find(buf, b'\r\n', pos, self._he)
+            colon = _find(buf, b':', pos, eol)
+            if colon - pos == n:
+                i = 0
+                while i < n and (buf[pos+i] | 0x20 if 0x41 <= buf[pos+i] <= 0x5A else buf[pos+i]) == name[i]:
+                    i += 1
+                if i == n:
+                    s = colon+1
+                    while s < eol and buf[s] in (0x20, 0x09):
+                        s += 1
+                    e = eol
+                    while e > s and buf[e-1] in (0x20, 0x09):
+                        e -= 1
+                    return s, e
+            pos = eol+2
+        return None
+
+    # Header value as bytes, like dict.get. Names are lowercase bytes.
+    def get(self, name, default=None):
+        span = self._header(name)
+        if span is None:
+            return default
+        return bytes(self._mv[span[0]:span[1]])
+
+    def __getitem__(self, name):
+        value = self.get(name)
+        if value is None:
+            raise KeyError(name)
+        return value
+
+    def __contains__(self, name):
+        return self._header(name) is not None
+
+    # True if header `name` contains `token`, without copying the value out
+    def headerHas(self, name, token):
+        span = self._header(name)
+        return span is not None and _find(self.buf, token, span[0], span[1]) >= 0
+
+    # headerHas() ignoring case, token is lowercase bytes
+    def _headerHasLower(self, name, token):
+        span = self._header(name)
+        if span is None:
+            return False
+        buf = self.buf
+        n = len(token)
+        for i in range(span[0], span[1]-n+1):
+            j = 0
+            while j < n and (buf[i+j] | 0x20 if 0x41 <= buf[i+j] <= 0x5A else buf[i+j]) == token[j]:
+                j += 1
+            if j == n:
+                return True
+        return False
+
+    # (start, end) of the raw value of query parameter `name`, or None
+    def _param(self, name):
+        pos = self._qs
+        n = len(name)
+        while pos < self._qe:
+            amp = _find(self.buf, b'&', pos, self._qe)
+            if amp < 0:
+                amp = self._qe
+            if (amp - pos == n or (amp - pos > n and self.buf[pos+n] == 0x3D)) and _find(self.buf, name, pos, pos+n) == pos:
+                return min(pos+n+1, amp), amp
+            pos = amp+1
+        return None
+
+    # Decoded query parameter as a str ('+' and %XX escapes), or default if it isn't there or the escapes
+    # aren't valid UTF-8
+    def query(self, name, default=None):
+        span = self._param(name)
+        if span is None:
+            return default
+        try:
+            return unquote(self._mv[span[0]:span[1]])
+        except UnicodeError: # eg. %FF, UnicodeDecodeError on CPython
+            return default
+
+    # Query parameter as an int, parsed in place. default if missing, ValueError if it isn't a whole number.
+    def queryInt(self, name, default=None):
+        span = self._param(name)
+        if span is None:
+            return default
+        s, e = span
+        neg = s < e and self.buf[s] == 0x2D
+        if neg:
+            s += 1
+        if s == e:
+            raise ValueError('not a number')
+        value = 0
+        for i in range(s, e):
+            d = self.buf[i] - 0x30
+            if not 0 <= d <= 9:
+                raise ValueError('not a number')
+            value = value*10 + d
+        return -value if neg else value
+
+# Raises UnicodeError if the escapes don't decode as UTF-8
+def unquote(raw):
+    out = bytearray()
+    i = 0
+    n = len(raw)
+    while i < n:
+        c = raw[i]
+        if c == 0x2B: # +
+            out.append(0x20)
+        elif c == 0x25 and i+2 < n and _hexval(raw[i+1]) >= 0 and _hexval(raw[i+2]) >= 0: # %XX
+            out.append(_hexval(raw[i+1]) << 4 | _hexval(raw[i+2]))
+            i += 2
+        else:
+            out.append(c)
+        i += 1
+    return out.decode()
+
+def _hexval(c):
+    if 0x30 <= c <= 0x39:
+        return c - 0x30
+    c |= 0x20
+    if 0x61 <= c <= 0x66:
+        return c - 0x57
+    return -1
+
+def _remaining(deadline):
+    return time.ticks_diff(deadline, time.ticks_ms()) / 1000
+
+# Admission control. _active counts connection slots in use, _waiting holds an Event per queued connection;
+# a slot that frees up is handed straight to the oldest waiter, so the queue is first come first served.
+_active = 0
+_streams = 0
+_waiting = []
+
+# Wait for a connection slot. False if max_queued are already waiting or none frees up in queue_timeout_sec.
+async def admit():
+    global _active
+    if _active < max_connections and not _waiting:
+        _active += 1
+        return True
+    if len(_waiting) >= max_queued:
+        return False
+    ev = asyncio.Event()
+    _waiting.append(ev)
+    hs_metrics.queuedConnections.inc()
+    try:
+        await asyncio.wait_for(ev.wait(), queue_timeout_sec)
+    except asyncio.TimeoutError:
+        pass
+    except asyncio.CancelledError:
+        if ev.is_set(): # A slot had already been handed over
+            _leave()
+        else:
+            _waiting.remove(ev)
+        raise
+    finally:
+        hs_metrics.queuedConnections.dec()
+    if ev.is_set():
+        return True
+    _waiting.remove(ev)
+    return False
+
+# True while connections are queued. Kept-alive connections then close after their current response, so the
+# slots rotate between clients instead of the first few keeping them.
+def busy():
+    return len(_waiting) > 0
+
+def _leave():
+    global _active
+    if _waiting:
+        _waiting.pop(0).set()
+    else:
+        _active -= 1
+
+# Turn a connection away without reading its request
+async def reject(writer):
+    hs_metrics.rejected.inc()
+    sendError(writer, UNAVAILABLE, headers='Retry-After: 1\r\n')
+    await drain(writer)
+
+# For handlers that hold the connection open (SSE, WebSocket): moves it from a connection slot to one of
+# max_streams stream slots, so open dashboards can't starve ordinary requests. False if those are all taken.
+def startStream(req):
+    global _streams
+    if req.streaming:
+        return True
+    if _streams >= max_streams:
+        return False
+    _streams += 1
+    req.streaming = True
+    _leave()
+    return True
+
+# Parsers are reused between connections, so buffers are allocated once rather than per connection.
+# Admission keeps the pool to max_connections + max_streams buffers.
+_requests = []
+
+# Call after admit() succeeded
+def acquireRequest():
+    if _requests:
+        return _requests.pop()
+    return Request()
+
+# Returns the parser to the pool and frees the connection's slot
+def releaseRequest(req):
+    global _streams
+    if req.streaming:
+        _streams -= 1
+    else:
+        _leave()
+    req._len = req._end = req._skip = 0
+    req.reader = req.sensors = None
+    req.streaming = False
+    _requests.append(req)
+
+# writer.drain() with a deadline, raises asyncio.TimeoutError if the client isn't reading
+async def drain(writer):
+    await asyncio.wait_for(writer.drain(), write_timeout_sec)
+
+# Server-Sent Events: hold the connection open and send render(), a whole encoded event, each time `event`
+# fires and it has changed. A quiet stream still gets a comment every heartbeat_sec: a client that vanished (a phone
+# that went to sleep never closes the socket) is only noticed when a write fails or drain() times out, and that
+# needs something to write. Either frees its stream slot.
+async def streamEvents(writer, event, render):
+    lastSent = None
+    try:
+        while True:
+            update = render()
+            if update != lastSent:
+                writer.write(update)
+                await drain(writer)
+                lastSent = update
+            try:
+                await asyncio.wait_for(event.wait(), heartbeat_sec)
+            except asyncio.TimeoutError:
+                writer.write(b':\n\n')
+                await drain(writer)
+    except asyncio.TimeoutError: # Not reading, don't let its backlog pile up in the heap
+        hs_metrics.timeouts.inc()
+    except OSError: # Client went away
+        pass
+
+# Keep answering requests on this connection until the client closes it, goes idle, or hits max_requests
+async def _handleRequests(req, reader, writer, router):
+    served = 0
+    while served < max_requests:
+        status = await req.read(reader)
+        if status is None:
+            break
+        if status != OK: # Malformed, oversized or too slow, and we can't tell where the next request starts
+            sendError(writer, status)
+            await drain(writer)
+            break
+        if hs_metrics.debug:
+            hs_metrics.log("Request:", req.method(), req.path())
+        hs_metrics.requests.inc()
+        t0 = time.ticks_us()
+        served += 1
+        keepAlive = req.keepAlive() and served < max_requests and not busy()
+
+        handler = router.match(req)
+        if handler is None:
+            sendError(writer, 404, keepAlive=keepAlive)
+        else:
+            tookOver = handler(req, writer, keepAlive)
+            if hasattr(tookOver, 'send'): # coroutine
+                tookOver = await tookOver
+            if tookOver:
+                break
+
+        hs_metrics.renderTime.since(t0)
+        t0 = time.ticks_us()
+        await drain(writer)
+        hs_metrics.writeTime.since(t0)
+        if not keepAlive:
+            break
+    await drain(writer)
+
+# One connection from accept to close: admission, then requests dispatched through router. Whatever happens
+# in a handler the socket is closed and the slot freed. sensors ends up in req.sensors for the handlers.
+async def serve(reader, writer, router, sensors=None):
+    hs_metrics.log("Client connected")
+    hs_metrics.connections.inc()
+    hs_metrics.activeConnections.inc()
+    try:
+        if not await admit(): # Busy - better a quick 503 than a socket held until the heap runs out
+            await reject(writer)
+        else:
+            req = acquireRequest()
+            req.sensors = sensors
+            try:
+                await _handleRequests(req, reader, writer, router)
+            finally:
+                releaseRequest(req)
+    except asyncio.TimeoutError: # Not reading its responses
+        hs_metrics.timeouts.inc()
+    except OSError: # Client went away mid-response
+        pass
+    except Exception as e: # A handler bug, drop the connection rather than the server
+        hs_metrics.handlerErrors.inc()
+        print('Request failed:', repr(e))
+    finally:
+        hs_metrics.activeConnections.dec()
+        writer.close()
+        try:
+            await writer.wait_closed()
+        except OSError:
+            pass
+        hs_metrics.log("Client disconnected")
+
+# Dispatch on the path (query string excluded). Exact paths are grouped by length so a lookup only compares
+# against paths of the right size, prefixes are tried longest first. Handlers are called as
+# handler(req, writer, keepAlive), and may be coroutines; one that returns True has taken over the connection.
+class Router:
+    def __init__(self):
+        self._exact = {} # Path length: [(path, handler)]
+        self._prefix = [] # (prefix, handler)
+
+    def add(self, path, handler, prefix=False):
+        if type(path) == str:
+            path = path.encode()
+        if prefix:
+            self._prefix = [r for r in self._prefix if r[0] != path] + [(path, handler)]
+            self._prefix.sort(key=lambda r: -len(r[0]))
+        else:
+            routes = [r for r in self._exact.get(len(path), []) if r[0] != path]
+            routes.append((path, handler))
+            self._exact[len(path)] = routes
+
+    def remove(self, path):
+        if type(path) == str:
+            path = path.encode()
+        self._prefix = [r for r in self._prefix if r[0] != path]
+        routes = [r for r in self._exact.get(len(path), []) if r[0] != path]
+        if routes:
+            self._exact[len(path)] = routes
+        else:
+            self._exact.pop(len(path), None)
+
+    def match(self, req):
+        for path, handler in self._exact.get(req._pe - req._ps, ()):
+            if req.pathIs(path):
+                return handler
+        for prefix, handler in self._prefix:
+            if req.pathStartsWith(prefix):
+                return handler
+        return None
+
+def sendResponse(writer, body=b'', ctype='text/html', status='200 OK', keepAlive=False, headers=''):
+    if type(body) == str:
+        body = body.encode()
+    if keepAlive:
+        connection = 'keep-alive\r\nKeep-Alive: timeout={}, max={}'.format(idle_timeout_sec, max_requests)
+    else:
+        connection = 'close'
+    if status[:3] == '304': # No body, and a Content-Length would have to be the full response's (RFC 9110 8.6)
+        length = ''
+    else:
+        length = 'Content-Length: {}\r\n'.format(len(body))
+    writer.write('HTTP/1.1 {}\r\nContent-Type: {}\r\n{}Connection: {}\r\n{}\r\n'.format(
+        status, ctype, length, connection, headers).encode())
+    if body:
+        writer.write(body)
+
+_REASONS = {BAD_REQUEST: '400 Bad Request', 404: '404 Not Found', TIMEOUT: '408 Request Timeout',
+            LENGTH_REQUIRED: '411 Length Required', BODY_TOO_LARGE: '413 Content Too Large',
+            TOO_LARGE: '431 Request Header Fields Too Large', UNAVAILABLE: '503 Service Unavailable'}
+
+# Plain text error response, the reason phrase doubles as the body
+def sendError(writer, code, keepAlive=False, headers=''):
+    status = _REASONS.get(code, str(code))
+    sendResponse(writer, status, ctype='text/plain', status=status, keepAlive=keepAlive, headers=headers)
+
+def _gzip(body):
+    if deflate is not None:
+        try:
+            buf = io.BytesIO()
+            g = deflate.DeflateIO(buf, deflate.GZIP)
+            g.write(body)
+            g.close()
+            return buf.getvalue()
+        except Exception: # Port built without compression support
+            return None
+    try:
+        import gzip # CPython
+        return gzip.compress(body)
+    except ImportError:
+        return None
+
+# A response rendered once into bytes, served with a strong ETag and optionally gzipped.
+# Re-create it when whatever it was rendered from changes.
+class CachedPage:
+    def __init__(self, body, ctype='text/html', compress=True):
+        if type(body) == str:
+            body = body.encode()
+        self.body = body
+        self.ctype = ctype
+        self.etag = '"' + binascii.hexlify(hashlib.sha256(body).digest()[:8]).decode() + '"'
+        self.gzBody = _gzip(body) if compress else None
+        if self.gzBody is not None and len(self.gzBody) >= len(body): # Not worth it
+            self.gzBody = None
+        self.gzEtag = self.etag[:-1] + '-gz"' # Strong ETags differ per content-coding
+        self._etags = (self.etag.encode(), self.gzEtag.encode())
+
+    def send(self, writer, req, keepAlive=False):
+        gz = self.gzBody is not None and req.headerHas(b'accept-encoding', b'gzip')
+        etag = self.gzEtag if gz else self.etag
+        cacheHeaders = 'ETag: {}\r\nCache-Control: no-cache\r\nVary: Accept-Encoding\r\n'.format(etag)
+        if req.headerHas(b'if-none-match', self._etags[gz]) or req.get(b'if-none-match') == b'*':
+            sendResponse(writer, status='304 Not Modified', ctype=self.ctype, keepAlive=keepAlive, headers=cacheHeaders)
+        elif gz:
+            sendResponse(writer, self.gzBody, ctype=self.ctype, keepAlive=keepAlive, headers=cacheHeaders + 'Content-Encoding: gzip\r\n')
+        else:
+            sendResponse(writer, self.body, ctype=self.ctype, keepAlive=keepAlive, headers=cacheHeaders)
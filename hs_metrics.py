@@ -0,0 +1,144 @@
+'''
+HomeStation metrics
+Counters, gauges and fixed-bucket histograms cheap enough for the request hot path - an observation is a
+few integer adds, no strings are built until /metrics is scraped. render() returns everything in the
+Prometheus text format, along with per-address I2C counts from PiicoDev_Unified and the heap and GC stats.
+
+The per-request prints are behind debug, since over USB serial they cost more than the request itself.
+'''
+
+import gc
+import time
+import uasyncio as asyncio
+
+debug = False # Set True for a line per connection and request
+
+def log(*args):
+    if debug:
+        print(*args)
+
+_metrics = [] # Rendered in creation order
+
+class Counter:
+    kind = 'counter'
+
+    def __init__(self, name, help):
+        self.name = name
+        self.help = help
+        self.value = 0
+        _metrics.append(self)
+
+    def inc(self, n=1):
+        self.value += n
+
+    def render(self, out):
+        out.append('{} {}\n'.format(self.name, self.value))
+
+class Gauge(Counter):
+    kind = 'gauge'
+
+    def dec(self, n=1):
+        self.value -= n
+
+    def set(self, value):
+        self.value = value
+
+# Bucket upper bounds are integers (microseconds by default), scale converts them to the exported unit
+US_BUCKETS = (100, 250, 500, 1000, 2500, 5000, 10000, 25000, 50000, 100000, 250000, 1000000)
+
+class Histogram:
+    kind = 'histogram'
+
+    def __init__(self, name, help, buckets=US_BUCKETS, scale=1e-6):
+        self.name = name
+        self.help = help
+        self.buckets = buckets
+        self.scale = scale
+        self._le = ['{:g}'.format(b*scale) for b in buckets]
+        self.counts = [0]*(len(buckets)+1) # Per bucket, the last one is +Inf
+        self.sum = 0
+        self.count = 0
+        _metrics.append(self)
+
+    def observe(self, value):
+        i = 0
+        n = len(self.buckets)
+        while i < n and value > self.buckets[i]:
+            i += 1
+        self.counts[i] += 1
+        self.sum += value
+        self.count += 1
+
+    # Observe the microseconds since t0 = time.ticks_us()
+    def since(self, t0):
+        self.observe(time.ticks_diff(time.ticks_us(), t0))
+
+    def render(self, out):
+        total = 0
+        for i in range(len(self.buckets)):
+            total += self.counts[i]
+            out.append('{}_bucket{{le="{}"}} {}\n'.format(self.name, self._le[i], total))
+        out.append('{}_bucket{{le="+Inf"}} {}\n'.format(self.name, self.count))
+        out.append('{}_sum {:g}\n'.format(self.name, self.sum*self.scale))
+        out.append('{}_count {}\n'.format(self.name, self.count))
+
+# Webserver
+connections = Counter('homestation_http_connections_total', 'TCP connections accepted')
+activeConnections = Gauge('homestation_http_connections_active', 'TCP connections open now')
+queuedConnections = Gauge('homestation_http_connections_queued', 'Connections waiting for a free slot')
+rejected = Counter('homestation_http_rejected_total', 'Connections turned away with 503')
+timeouts = Counter('homestation_http_timeouts_total', 'Connections dropped for sending or reading too slowly')
+requests = Counter('homestation_http_requests_total', 'HTTP requests read')
+handlerErrors = Counter('homestation_http_handler_errors_total', 'Connections dropped because a handler raised')
+headerTime = Histogram('homestation_http_header_read_seconds', 'Request line received to end of headers')
+renderTime = Histogram('homestation_http_render_seconds', 'Routing and building the response')
+writeTime = Histogram('homestation_http_write_seconds', 'Draining the response to the socket')
+
+# Sensors and memory
+sampleTime = Histogram('homestation_sample_seconds', 'One pass of the sensor sampler')
+sampleErrors = Counter('homestation_sample_errors_total', 'Sampler passes that raised')
+gcTime = Histogram('homestation_gc_seconds', 'Explicit gc.collect() calls')
+heapFree = Gauge('homestation_heap_free_bytes', 'Free heap after the last scrape or collection')
+heapAlloc = Gauge('homestation_heap_allocated_bytes', 'Allocated heap after the last scrape or collection')
+
+def _heap():
+    try: # MicroPython only
+        heapFree.set(gc.mem_free())
+        heapAlloc.set(gc.mem_alloc())
+    except AttributeError:
+        pass
+
+# Timed collection. Collecting on our own schedule keeps the automatic collections (which land
+# in the middle of a request) short.
+def collect():
+    t0 = time.ticks_us()
+    gc.collect()
+    gcTime.since(t0)
+    _heap()
+
+async def gcTask(interval=10):
+    while True:
+        await asyncio.sleep(interval)
+        collect()
+
+def _i2c(out):
+    try:
+        from PiicoDev_Unified import bus_stats
+    except ImportError:
+        return
+    stats = bus_stats()
+    for name, index, help in (('piicodev_i2c_transactions_total', 0, 'I2C transactions per device'),
+                              ('piicodev_i2c_errors_total', 1, 'Failed I2C transactions per device')):
+        out.append('# HELP {} {}\n# TYPE {} counter\n'.format(name, help, name))
+        for bus, addrs in stats:
+            for addr, counts in addrs.items():
+                out.append('{}{{bus="{}",addr="0x{:02X}"}} {}\n'.format(name, bus, addr, counts[index]))
+
+def render():
+    _heap()
+    out = []
+    for metric in _metrics:
+        out.append('# HELP {} {}\n# TYPE {} {}\n'.format(metric.name, metric.help, metric.name, metric.kind))
+        metric.render(out)
+    _i2c(out)
+    return ''.join(out)
@@ -0,0 +1,118 @@
+'''
+HomeStation OLED dashboard
+Lines of text on the PiicoDev SSD1306 (128x64), refreshed without pushing the whole 1 KB framebuffer.
+Only the characters that changed are redrawn, and each 8 pixel page keeps the column span that changed,
+so a new reading costs a few dozen bytes on the bus instead of a full show(). Pushes go through the shared
+bus's arbiter at low priority, one page per acquisition, and no more often than max_fps.
+'''
+
+import time
+import uasyncio as asyncio
+from PiicoDev_Unified import PRIORITY_LOW
+
+CHAR_W = 8 # framebuf's built-in font is 8x8, one text row per page
+_CONTROL_CMDS = 0x00 # Control byte for a stream of commands (the driver sends them one per 0x80 write)
+_CONTROL_DATA = 0x40
+_SET_COL_ADDR = 0x21
+_SET_PAGE_ADDR = 0x22
+
+retry_sec = 5 # Between refresh attempts while the display isn't answering
+
+class Dashboard:
+    def __init__(self, display, max_fps=4, priority=PRIORITY_LOW):
+        self.display = display
+        self.width = display.width
+        self.pages = display.height // 8
+        self.cols = self.width // CHAR_W
+        self.min_interval_ms = 1000 // max_fps
+        self.priority = priority
+        self.lines = [''] * self.pages
+        self._lo = bytearray(b'\xff' * self.pages) # Dirty column span per page, empty when lo > hi
+        self._hi = bytearray(self.pages)
+        self._cmd = bytearray((_SET_COL_ADDR, 0, 0, _SET_PAGE_ADDR, 0, 0))
+        self._mv = memoryview(display.buffer)
+        self._changed = asyncio.Event()
+        self.running = False # run() is pushing changes, otherwise call refresh() yourself
+        self.pushes = 0 # Page writes, for tuning
+        self.bytesPushed = 0
+        display.fill(0)
+        self.invalidate()
+
+    # Push everything on the next refresh, eg. after the panel was reset
+    def invalidate(self):
+        for page in range(self.pages):
+            self._markDirty(page, 0, self.width-1)
+
+    def _markDirty(self, page, x0, x1):
+        if self._lo[page] > self._hi[page]:
+            self._lo[page] = x0
+            self._hi[page] = x1
+        else:
+            self._lo[page] = min(self._lo[page], x0)
+            self._hi[page] = max(self._hi[page], x1)
+        self._changed.set()
+
+    def _clean(self, page):
+        self._lo[page] = 0xFF
+        self._hi[page] = 0
+
+    # Show text on row (0 at the top), redrawing only the characters that differ from what is there
+    def setLine(self, row, text):
+        text = text[:self.cols]
+        old = self.lines[row]
+        if text == old:
+            return
+        # Changed characters are [c0, c1), trailing ones that are gone count as changed
+        c0 = 0
+        while c0 < len(text) and c0 < len(old) and text[c0] == old[c0]:
+            c0 += 1
+        c1 = max(len(text), len(old))
+        while c1 > c0 and c1 <= len(text) and c1 <= len(old) and text[c1-1] == old[c1-1]:
+            c1 -= 1
+        y = row*8
+        self.display.fill_rect(c0*CHAR_W, y, (c1-c0)*CHAR_W, 8, 0)
+        self.display.text(text[c0:c1], c0*CHAR_W, y, 1)
+        self.lines[row] = text
+        self._markDirty(row, c0*CHAR_W, c1*CHAR_W - 1)
+
+    # Write one page's dirty columns, runs while holding the bus
+    def _pushPage(self, page):
+        lo = self._lo[page]
+        hi = self._hi[page]
+        if lo > hi:
+            return
+        self._clean(page)
+        cmd = self._cmd
+        cmd[1] = lo
+        cmd[2] = hi
+        cmd[4] = cmd[5] = page
+        i2c = self.display.i2c
+        addr = self.display.addr
+        i2c.writeto_mem(addr, _CONTROL_CMDS, cmd) # Window to just the dirty span, one transaction
+        start = page*self.width
+        i2c.writeto_mem(addr, _CONTROL_DATA, self._mv[start+lo:start+hi+1])
+        self.pushes += 1
+        self.bytesPushed += hi - lo + 1
+
+    async def refresh(self):
+        arbiter = self.display.i2c.arbiter
+        for page in range(self.pages):
+            if self._lo[page] <= self._hi[page]:
+                await arbiter.run(self._pushPage, page, priority=self.priority)
+
+    # Push changes as they come, at most max_fps times a second
+    async def run(self):
+        self.running = True
+        while True:
+            await self._changed.wait()
+            self._changed.clear()
+            t0 = time.ticks_ms()
+            try:
+                await self.refresh()
+            except OSError as e: # Unplugged - redraw everything once it's back
+                print('OLED refresh failed:', e)
+                self.invalidate()
+                await asyncio.sleep(retry_sec)
+            wait = self.min_interval_ms - time.ticks_diff(time.ticks_ms(), t0)
+            if wait > 0:
+                await asyncio.sleep_ms(wait)
@@ -0,0 +1,112 @@
+'''
+HomeStation WebSocket support
+Minimal RFC 6455 server side for the HomeStation webserver - one persistent, bidirectional
+connection per page instead of a new TCP connection for every colour picker event.
+
+Client -> server: binary frames, 3 bytes R G B for the LEDs
+Server -> client: text frames with the sensor HTML (only if a push event is supplied)
+'''
+
+import hashlib
+import binascii
+import uasyncio as asyncio
+from hs_http import drain
+
+OP_CONT = 0x0
+OP_TEXT = 0x1
+OP_BINARY = 0x2
+OP_CLOSE = 0x8
+OP_PING = 0x9
+OP_PONG = 0xA
+
+max_payload = 125 # Colour commands are 3 bytes, anything bigger than a control frame is refused
+ping_interval_sec = 15 # Ping a client that has sent nothing for this long, drop it if the next interval passes too
+frame_timeout_sec = 5 # for the rest of a frame once its first bytes have arrived
+
+_GUID = b'258EAFA5-E914-47DA-95CA-C5AB0DC85B11'
+
+def acceptKey(key):
+    return binascii.b2a_base64(hashlib.sha1(key + _GUID).digest()).strip()
+
+def handshake(writer, key):
+    writer.write(b'HTTP/1.1 101 Switching Protocols\r\nUpgrade: websocket\r\nConnection: Upgrade\r\nSec-WebSocket-Accept: ')
+    writer.write(acceptKey(key))
+    writer.write(b'\r\n\r\n')
+
+# Server frames are never masked or fragmented
+def writeFrame(writer, opcode, payload=b''):
+    if type(payload) == str:
+        payload = payload.encode()
+    n = len(payload)
+    if n < 126:
+        writer.write(bytes((0x80 | opcode, n)))
+    else:
+        writer.write(bytes((0x80 | opcode, 126, n >> 8, n & 0xFF)))
+    writer.write(payload)
+
+# Returns (opcode, payload), (None, b'') if no frame started within timeout [s], or (OP_CLOSE, b'') if the
+# frame can't be handled. Raises asyncio.TimeoutError if a frame stalls half way.
+async def readFrame(reader, timeout=None):
+    try:
+        hdr = await asyncio.wait_for(reader.readexactly(2), timeout)
+    except asyncio.TimeoutError:
+        return None, b''
+    opcode = hdr[0] & 0x0F
+    n = hdr[1] & 0x7F
+    if not hdr[0] & 0x80 or not hdr[1] & 0x80 or n > max_payload: # Fragmented, unmasked or too big
+        return OP_CLOSE, b''
+    rest = await asyncio.wait_for(reader.readexactly(4+n), frame_timeout_sec)
+    mask = rest[:4]
+    payload = bytearray(rest[4:])
+    for i in range(n):
+        payload[i] ^= mask[i & 3]
+    return opcode, payload
+
+async def _pushUpdates(writer, event, render):
+    lastSent = None
+    try:
+        while True:
+            update = render()
+            if update != lastSent:
+                writeFrame(writer, OP_TEXT, update)
+                await drain(writer)
+                lastSent = update
+            await event.wait()
+    except (OSError, asyncio.TimeoutError): # Client went away or stopped reading
+        pass
+
+# Run a WebSocket session until the client closes it or stops answering pings. onBinary(payload) is called
+# for every binary frame. If event and render are given, render() is pushed as a text frame each time the
+# event fires.
+async def serve(reader, writer, key, onBinary, event=None, render=None):
+    handshake(writer, key)
+    await drain(writer)
+    pusher = None
+    if event is not None:
+        pusher = asyncio.create_task(_pushUpdates(writer, event, render))
+    pinged = False
+    try:
+        while True:
+            opcode, payload = await readFrame(reader, ping_interval_sec)
+            if opcode is None: # Quiet - a sleeping phone or a dropped link never closes the socket itself
+                if pinged:
+                    break
+                writeFrame(writer, OP_PING)
+                await drain(writer)
+                pinged = True
+                continue
+            pinged = False # Any frame, pong or not, shows it's alive
+            if opcode == OP_BINARY:
+                onBinary(payload)
+            elif opcode == OP_PING:
+                writeFrame(writer, OP_PONG, payload)
+                await drain(writer)
+            elif opcode == OP_CLOSE:
+                writeFrame(writer, OP_CLOSE)
+                await drain(writer)
+                break
+    except (OSError, EOFError, asyncio.TimeoutError): # Client went away or stopped reading
+        pass
+    finally:
+        if pusher is not None:
+            pusher.cancel()
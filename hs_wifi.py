@@ -0,0 +1,144 @@
+'''
+HomeStation WiFi supervisor
+Brings the link up without blocking the event loop, so the webserver, sampler and LEDs keep running while
+the radio connects. Failed attempts are retried with exponential backoff, and a link that drops later is
+noticed and re-established - the server never has to be restarted.
+
+Every time the link comes up the clock is set from NTP (syncClock), since the Pico W's RTC starts from the
+same value on every boot. clockSet says whether time.time() can be trusted yet.
+
+statusLed() shows the supervisor's state on the Pico W's LED, one blink pattern per state.
+'''
+
+import time
+import uasyncio as asyncio
+import hs_metrics
+
+# wlan.status() values on the Pico W (network.STAT_*)
+STAT_GOT_IP = 3
+STAT_WRONG_PASSWORD = -3
+
+# Supervisor states
+CONNECTING = 0
+CONNECTED = 1
+RETRYING = 2 # Waiting out the backoff after a failed attempt
+BAD_AUTH = 3 # As RETRYING, but the access point refused the password
+
+STATE_NAMES = ('connecting', 'connected', 'retrying', 'bad password')
+
+# LED patterns per state, alternating on and off times [ms] starting with on
+PATTERNS = (
+    (100, 100), # CONNECTING: fast flicker
+    (50, 2950), # CONNECTED: short heartbeat every 3 s
+    (100, 150, 100, 1650), # RETRYING: double blink
+    (100, 150, 100, 150, 100, 1400), # BAD_AUTH: triple blink
+)
+
+clockSet = False # True once the RTC has been set from NTP
+clock_retry_sec = 30
+
+# Set the RTC from NTP, retrying until it works. ntptime blocks for up to its 1 s timeout per attempt.
+async def syncClock():
+    global clockSet
+    while True:
+        try:
+            import ntptime
+            ntptime.settime()
+        except ImportError: # Not a MicroPython network port, the OS keeps the clock
+            clockSet = True
+            return
+        except Exception as e: # No reply, or DNS not up yet
+            print('NTP failed ({}), retrying in {} s'.format(e, clock_retry_sec))
+            await asyncio.sleep(clock_retry_sec)
+        else:
+            clockSet = True
+            print('Clock set from NTP')
+            return
+
+connected = hs_metrics.Gauge('homestation_wifi_connected', '1 while the WiFi link is up')
+reconnects = hs_metrics.Counter('homestation_wifi_reconnects_total', 'Times the WiFi link dropped and was brought back')
+
+class WiFi:
+    def __init__(self, wlan, ssid, password, onConnect=None, connect_timeout_sec=15, check_interval_sec=2,
+                 backoff_min_sec=1, backoff_max_sec=60):
+        self.wlan = wlan
+        self.ssid = ssid
+        self.password = password
+        self.onConnect = onConnect # Called with the IP address each time the link comes up
+        self.connect_timeout_sec = connect_timeout_sec
+        self.check_interval_sec = check_interval_sec
+        self.backoff_min_sec = backoff_min_sec
+        self.backoff_max_sec = backoff_max_sec
+        self.state = CONNECTING
+        self.ip = None
+        self.attempts = 0 # Failed attempts since the link was last up
+        self._clockTask = None
+
+    def isConnected(self):
+        return self.wlan.status() == STAT_GOT_IP
+
+    def _setState(self, state):
+        if state != self.state:
+            hs_metrics.log('WiFi:', STATE_NAMES[state])
+        self.state = state
+        connected.set(1 if state == CONNECTED else 0)
+
+    # One connection attempt, polling the radio instead of sleeping on it. True once there's an IP address.
+    async def connect(self):
+        self._setState(CONNECTING)
+        self.wlan.active(True)
+        self.wlan.config(pm = 0xa11140)  # Disable powersave mode
+        self.wlan.connect(self.ssid, self.password)
+        t0 = time.ticks_ms()
+        while time.ticks_diff(time.ticks_ms(), t0) < self.connect_timeout_sec*1000:
+            status = self.wlan.status()
+            if status < 0 or status >= STAT_GOT_IP:
+                break
+            await asyncio.sleep_ms(250)
+        if not self.isConnected():
+            return False
+        self.ip = self.wlan.ifconfig()[0]
+        self.attempts = 0
+        self._setState(CONNECTED)
+        print('WiFi connected, IP = ' + self.ip)
+        if self._clockTask is None or self._clockTask.done(): # Also corrects drift on every reconnect
+            self._clockTask = asyncio.create_task(syncClock())
+        if self.onConnect is not None:
+            self.onConnect(self.ip)
+        return True
+
+    def _backoff(self):
+        return min(self.backoff_max_sec, self.backoff_min_sec * 2**min(self.attempts-1, 10))
+
+    # Connect, then keep the link up for as long as the task runs
+    async def run(self):
+        while True:
+            if not await self.connect():
+                status = self.wlan.status()
+                self.attempts += 1
+                self._setState(BAD_AUTH if status == STAT_WRONG_PASSWORD else RETRYING)
+                wait = self._backoff()
+                print('WiFi connection failed (status {}), retrying in {} s'.format(status, wait))
+                self.wlan.disconnect() # Drop any half-made association before the next try
+                await asyncio.sleep(wait)
+                continue
+            while self.isConnected():
+                await asyncio.sleep(self.check_interval_sec)
+            print('WiFi link lost, reconnecting')
+            reconnects.inc()
+            self.ip = None
+            self.wlan.disconnect()
+
+# Blink `led` in the pattern for wifi's current state. Checks the state every step, so a change shows at once.
+async def statusLed(led, wifi, step_ms=50):
+    while True:
+        state = wifi.state
+        pattern = PATTERNS[state]
+        for i in range(len(pattern)):
+            led.value(1 if i % 2 == 0 else 0)
+            left = pattern[i]
+            while left > 0 and wifi.state == state:
+                await asyncio.sleep_ms(min(step_ms, left))
+                left -= step_ms
+            if wifi.state != state:
+                break
@@ -4,12 +4,126 @@
 # Original repo https://bit.ly/2yJwysL
 
 from PiicoDev_Unified import *
+import struct
+try:
+    import uasyncio as asyncio
+except ImportError:
+    try:
+        import asyncio
+    except ImportError:
+        asyncio = None # async API unavailable on this port
+try:
+    import numpy as np # CPython, for compensate_batch()
+    if not hasattr(np, 'int64'): # ulab has no 64 bit integers
+        np = None
+except ImportError:
+    np = None
+
+# Standby time between normal-mode conversions [ms], indexed by t_sb
+_T_SB_MS = (0.5, 62.5, 125, 250, 500, 1000, 10, 20)
+
+# Bosch integer compensation of one raw sample, as in the datasheet but with exact (unbounded) integers.
+# cal is PiicoDev_BME280.calibration(). Returns (t_fine, temperature [0.01 degC], pressure [Pa, Q24.8], humidity [%RH, Q22.10])
+def _compensate_sample(cal, raw_t, raw_p, raw_h):
+    T1, T2, T3, P1, P2, P3, P4, P5, P6, P7, P8, P9, H1, H2, H3, H4, H5, H6 = cal
+    var1 = ((raw_t>>3)-(T1<<1))*(T2>>11)
+    var2 = (raw_t >> 4)-T1
+    var2 = var2*((raw_t>>4)-T1)
+    var2 = ((var2>>12)*T3)>>14
+    t_fine = var1+var2
+    temp = (t_fine*5+128)>>8
+    var1 = t_fine-128000
+    var2 = var1*var1*P6
+    var2 = var2+((var1*P5)<<17)
+    var2 = var2+(P4<<35)
+    var1 = (((var1*var1*P3)>>8)+
+            ((var1*P2)<<12))
+    var1 = (((1<<47)+var1)*P1)>>33
+    if var1 == 0:
+        pres = 0
+    else:
+        p = ((((1048576-raw_p)<<31)-var2)*3125)//var1
+        var1 = (P9*(p>>13)*(p >> 13))>>25
+        var2 = (P8*p)>>19
+        pres = ((p+var1+var2)>>8)+(P7<<4)
+    h = t_fine-76800
+    h = (((((raw_h<<14)-(H4<<20)-
+            (H5*h))+16384)
+          >>15)*(((((((h*H6)>>10)*
+                        (((h*H3)>>11)+32768))>>10)+
+                      2097152)*H2+8192)>>14))
+    h = h-(((((h>>15)*(h>>15))>>7)*H1)>>4)
+    h = 0 if h < 0 else h
+    h = 419430400 if h>419430400 else h
+    humi = h>>12
+    return (t_fine, temp, pres, humi)
+
+# Compensate one raw (temperature, pressure, humidity) triple without a sensor attached, eg. replaying logged raw data
+def compensate(cal, raw_t, raw_p, raw_h):
+    return _compensate_sample(cal, raw_t, raw_p, raw_h)[1:]
+
+# Compensate sequences of raw samples. Returns (temperature, pressure, humidity) arrays in the same units as
+# read_compensated_data(), identical to compensating each sample on its own.
+def compensate_batch(cal, raw_t, raw_p, raw_h):
+    if np is not None:
+        return _compensate_numpy(cal, raw_t, raw_p, raw_h)
+    from array import array
+    n = len(raw_t)
+    temp, pres, humi = array('q', [0]*n), array('q', [0]*n), array('q', [0]*n)
+    for i in range(n):
+        _, temp[i], pres[i], humi[i] = _compensate_sample(cal, raw_t[i], raw_p[i], raw_h[i])
+    return temp, pres, humi
+
+# The same arithmetic on int64 columns. >> and // on numpy ints floor like Python's, so results match as long as
+# nothing overflows - real readings stay far below 2**63, and any sample whose intermediates could overflow
+# is redone with exact integers.
+_P_NUM_MAX = (2**63 - 1) // 3125
+
+def _compensate_numpy(cal, raw_t, raw_p, raw_h):
+    T1, T2, T3, P1, P2, P3, P4, P5, P6, P7, P8, P9, H1, H2, H3, H4, H5, H6 = [np.int64(c) for c in cal]
+    raw_t = np.asarray(raw_t, dtype=np.int64)
+    raw_p = np.asarray(raw_p, dtype=np.int64)
+    raw_h = np.asarray(raw_h, dtype=np.int64)
+    with np.errstate(over='ignore', divide='ignore'):
+        var1 = ((raw_t>>3)-(T1<<1))*(T2>>11)
+        var2 = (raw_t >> 4)-T1
+        var2 = var2*((raw_t>>4)-T1)
+        var2 = ((var2>>12)*T3)>>14
+        t_fine = var1+var2
+        temp = (t_fine*5+128)>>8
+        var1 = t_fine-128000
+        var2 = var1*var1*P6
+        var2 = var2+((var1*P5)<<17)
+        var2 = var2+(P4<<35)
+        var1 = (((var1*var1*P3)>>8)+
+                ((var1*P2)<<12))
+        a = (1<<47)+var1 # (a*P1)>>33 in two halves, a*P1 alone can pass 2**63
+        var1 = (((a>>16)*P1)+(((a & 0xFFFF)*P1)>>16))>>17
+        num = ((1048576-raw_p)<<31)-var2
+        zero = var1 == 0
+        p = (num*3125)//np.where(zero, 1, var1)
+        var1 = (P9*(p>>13)*(p >> 13))>>25
+        var2 = (P8*p)>>19
+        pres = np.where(zero, 0, ((p+var1+var2)>>8)+(P7<<4))
+        h = t_fine-76800
+        h = (((((raw_h<<14)-(H4<<20)-
+                (H5*h))+16384)
+              >>15)*(((((((h*H6)>>10)*
+                            (((h*H3)>>11)+32768))>>10)+
+                          2097152)*H2+8192)>>14))
+        unsafe = (((raw_t | raw_p) >> 20) != 0) | ((raw_h >> 16) != 0) # Not from a sensor
+        unsafe |= (np.abs(num) > _P_NUM_MAX) | (~zero & (np.abs(p) >= 2**36)) | (np.abs(h) >= 2**40)
+        h = h-(((((h>>15)*(h>>15))>>7)*H1)>>4)
+        humi = np.clip(h, 0, 419430400)>>12
+    for i in np.nonzero(unsafe)[0]:
+        _, temp[i], pres[i], humi[i] = _compensate_sample(cal, int(raw_t[i]), int(raw_p[i]), int(raw_h[i]))
+    return temp, pres, humi
 
 compat_str = '\nUnified PiicoDev library out of date.  Get the latest module: https://piico.dev/unified \n'
 
 class PiicoDev_BME280:
 
-    def __init__(self, bus=None, freq=None, sda=None, scl=None, t_mode=2, p_mode=5, h_mode=1, iir=1, address=0x77):
+    def __init__(self, bus=None, freq=None, sda=None, scl=None, t_mode=2, p_mode=5, h_mode=1, iir=1, address=0x77, normal_mode=False, t_sb=5):
         try:
             if compat_ind >= 1:
                 pass
@@ -22,39 +136,41 @@ class PiicoDev_BME280:
         self.p_mode = p_mode
         self.h_mode = h_mode
         self.iir = iir
+        self.t_sb = t_sb
+        self.normal_mode = False
         self.addr = address
 
         self._t_fine = 0
+        self._data = bytearray(8) # Reused by every data read
+        self.regs = self.i2c.shadow(self.addr) # ctrl_hum, ctrl_meas and config are only ever changed by us
+        self.regs.invalidate()
         try:
-            self._T1 = self._read16(0x88)
+            # Calibration table in two block reads: 0x88-0xA1 (T, P, H1) and 0xE1-0xE7 (H2-H6)
+            cal = bytes(self.i2c.readfrom_mem(self.addr, 0x88, 26))
         except Exception as e:
             print(i2c_err_str.format(self.addr))
             raise e
-        self._T2 = self._short(self._read16(0x8A))
-        self._T3 = self._short(self._read16(0x8C))
-        self._P1 = self._read16(0x8E)
-        self._P2 = self._short(self._read16(0x90))
-        self._P3 = self._short(self._read16(0x92))
-        self._P4 = self._short(self._read16(0x94))
-        self._P5 = self._short(self._read16(0x96))
-        self._P6 = self._short(self._read16(0x98))
-        self._P7 = self._short(self._read16(0x9A))
-        self._P8 = self._short(self._read16(0x9C))
-        self._P9 = self._short(self._read16(0x9E))
-        self._H1 = self._read8(0xA1)
-        self._H2 = self._short(self._read16(0xE1))
-        self._H3 = self._read8(0xE3)
-        a = self._read8(0xE5)
-        self._H4 = (self._read8(0xE4)<<4)+(a%16)
-        self._H5 = (self._read8(0xE6)<<4)+(a>>4)
-        self._H6 = self._read8(0xE7)
-        if self._H6 > 127:
-            self._H6 -= 256
-        self._write8(0xF2, self.h_mode)
+        H2, H3, e4, e5, e6, H6 = struct.unpack('<hBBBBb', bytes(self.i2c.readfrom_mem(self.addr, 0xE1, 7)))
+        self._cal = struct.unpack('<HhhHhhhhhhhhxB', cal) + (H2, H3, (e4<<4)+(e5%16), (e6<<4)+(e5>>4), H6)
+        self._configure()
+        if normal_mode:
+            self.set_normal_mode()
+
+    def _configure(self):
+        self._write_ctrl(0xF2, self.h_mode)
         sleep_ms(2)
-        self._write8(0xF4, 0x24)
+        self._write_ctrl(0xF4, 0x24)
         sleep_ms(2)
-        self._write8(0xF5, self.iir<<2)
+        self._write_ctrl(0xF5, self.iir<<2)
+
+    # Soft reset: the sensor comes back in sleep mode with its config cleared, so forget the shadowed registers
+    def reset(self):
+        self._write8(0xE0, 0xB6)
+        sleep_ms(2)
+        self.regs.invalidate()
+        self._configure()
+        if self.normal_mode:
+            self.set_normal_mode()
         
     def _read8(self, reg):
         t = self.i2c.readfrom_mem(self.addr, reg, 1)
@@ -67,14 +183,17 @@ class PiicoDev_BME280:
     def _write8(self, reg, dat):
         self.i2c.write8(self.addr, bytes([reg]), bytes([dat]))
 
+    # Control registers go through the register shadow, so rewriting an unchanged value costs nothing
+    def _write_ctrl(self, reg, dat):
+        self.regs.write_if_changed(reg, bytes([dat]))
+
     def _short(self, dat):
         if dat > 32767:
             return dat - 65536
         else:
             return dat
 
-    def read_raw_data(self):
-        self._write8(0xF4, (self.p_mode << 5 | self.t_mode << 2 | 1))
+    def _measure_time_ms(self):
         sleep_time = 1250
         if self.t_mode in [1, 2, 3, 4, 5]:
             sleep_time += 2300*(1<< self.t_mode)
@@ -82,13 +201,68 @@ class PiicoDev_BME280:
             sleep_time += 575+(2300*(1<<self.p_mode))
         if self.h_mode in [1, 2, 3, 4, 5]:
             sleep_time += 575+(2300*(1<<self.h_mode))
-        sleep_ms(1+sleep_time//1000)
+        return 1+sleep_time//1000
+
+    # Continuous conversions every measurement time + t_sb standby; values() then just reads the latest result
+    def set_normal_mode(self, t_sb=None, iir=None):
+        if t_sb is not None:
+            self.t_sb = t_sb
+        if iir is not None:
+            self.iir = iir
+        if not 0 <= self.t_sb <= 7:
+            raise ValueError('Invalid t_sb. Accepted values: 0-7')
+        self._write_ctrl(0xF4, (self.p_mode << 5 | self.t_mode << 2)) # config is only reliably written in sleep mode
+        self._write_ctrl(0xF5, self.t_sb<<5 | self.iir<<2)
+        self._write_ctrl(0xF4, (self.p_mode << 5 | self.t_mode << 2 | 3))
+        self.normal_mode = True
+        sleep_ms(self._measure_time_ms()) # wait for the first conversion so the data registers are valid
+
+    def set_forced_mode(self):
+        self._write_ctrl(0xF4, (self.p_mode << 5 | self.t_mode << 2))
+        self._write_ctrl(0xF5, self.iir<<2)
+        self.normal_mode = False
+
+    # Time between normal-mode results [ms]
+    def period_ms(self):
+        return self._measure_time_ms() + _T_SB_MS[self.t_sb]
+
+    # Trigger a forced-mode conversion, returns the time [ms] until the result is ready
+    def start_measurement(self):
+        if self.normal_mode: # already converting continuously
+            return 0
+        # Always written: the sensor drops back to sleep after a forced conversion, whatever the shadow says
+        self.regs.write(0xF4, bytes([self.p_mode << 5 | self.t_mode << 2 | 1]))
+        return self._measure_time_ms()
+
+    # One burst read of 0xF7-0xFE, so all three values come from the same shadow-register snapshot
+    def _read_data(self):
+        d = self._data
+        self.i2c.readfrom_mem_into(self.addr, 0xF7, d)
+        raw_p = ((d[0]<<16)|(d[1]<<8)|d[2])>>4
+        raw_t = ((d[3]<<16)|(d[4]<<8)|d[5])>>4
+        raw_h = (d[6] << 8)| d[7]
+        return (raw_t, raw_p, raw_h)
+
+    def read_raw_data(self):
+        if self.normal_mode:
+            return self._read_data()
+        sleep_ms(self.start_measurement())
         while(self._read16(0xF3) & 0x08):
             sleep_ms(1)
-        raw_p = ((self._read8(0xF7)<<16)|(self._read8(0xF8)<<8)|self._read8(0xF9))>>4
-        raw_t = ((self._read8(0xFA)<<16)|(self._read8(0xFB)<<8)|self._read8(0xFC))>>4
-        raw_h = (self._read8(0xFD) << 8)| self._read8(0xFE)
-        return (raw_t, raw_p, raw_h)
+        return self._read_data()
+
+    # As read_raw_data, but yields to the event loop while the conversion runs. The bus is only held for the
+    # trigger and for the status + data read; the conversion itself happens off-bus, so other drivers can use it.
+    async def read_raw_data_async(self, priority=PRIORITY_LOW):
+        arbiter = self.i2c.arbiter
+        if self.normal_mode:
+            return await arbiter.run(self._read_data, priority=priority)
+        await asyncio.sleep(await arbiter.run(self.start_measurement, priority=priority)/1000)
+        while True:
+            async with arbiter.lane(priority):
+                if not self._read16(0xF3) & 0x08:
+                    return self._read_data()
+            await asyncio.sleep(0.001)
 
     def read_compensated_data(self):
         try:
@@ -96,42 +270,32 @@ class PiicoDev_BME280:
         except:
             print(i2c_err_str.format(self.addr))
             return (float('NaN'), float('NaN'), float('NaN'))
-        var1 = ((raw_t>>3)-(self._T1<<1))*(self._T2>>11)
-        var2 = (raw_t >> 4)-self._T1
-        var2 = var2*((raw_t>>4)-self._T1)
-        var2 = ((var2>>12)*self._T3)>>14
-        self._t_fine = var1+var2
-        temp = (self._t_fine*5+128)>>8
-        var1 = self._t_fine-128000
-        var2 = var1*var1*self._P6
-        var2 = var2+((var1*self._P5)<<17)
-        var2 = var2+(self._P4<<35)
-        var1 = (((var1*var1*self._P3)>>8)+
-                ((var1*self._P2)<<12))
-        var1 = (((1<<47)+var1)*self._P1)>>33
-        if var1 == 0:
-            pres = 0
-        else:
-            p = ((((1048576-raw_p)<<31)-var2)*3125)//var1
-            var1 = (self._P9*(p>>13)*(p >> 13))>>25
-            var2 = (self._P8*p)>>19
-            pres = ((p+var1+var2)>>8)+(self._P7<<4)
-        h = self._t_fine-76800
-        h = (((((raw_h<<14)-(self._H4<<20)-
-                (self._H5*h))+16384)
-              >>15)*(((((((h*self._H6)>>10)*
-                            (((h*self._H3)>>11)+32768))>>10)+
-                          2097152)*self._H2+8192)>>14))
-        h = h-(((((h>>15)*(h>>15))>>7)*self._H1)>>4)
-        h = 0 if h < 0 else h
-        h = 419430400 if h>419430400 else h
-        humi = h>>12
+        return self._compensate(raw_t, raw_p, raw_h)
+
+    async def read_compensated_data_async(self):
+        try:
+            raw_t, raw_p, raw_h = await self.read_raw_data_async()
+        except Exception: # let task cancellation through
+            print(i2c_err_str.format(self.addr))
+            return (float('NaN'), float('NaN'), float('NaN'))
+        return self._compensate(raw_t, raw_p, raw_h)
+
+    def _compensate(self, raw_t, raw_p, raw_h):
+        self._t_fine, temp, pres, humi = _compensate_sample(self._cal, raw_t, raw_p, raw_h)
         return (temp, pres, humi)
 
+    # Trimming constants (T1-T3, P1-P9, H1-H6) for compensate() and compensate_batch()
+    def calibration(self):
+        return self._cal
+
     def values(self):
         temp, pres, humi = self.read_compensated_data()
         return (temp/100, pres/256,  humi/1024)
 
+    async def values_async(self):
+        temp, pres, humi = await self.read_compensated_data_async()
+        return (temp/100, pres/256,  humi/1024)
+
     def pressure_precision(self):
         p = self.read_compensated_data()[1]
         pi = float(p // 256)
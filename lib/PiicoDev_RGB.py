@@ -20,22 +20,54 @@ def wheel(h, s=1, v=1):
     if i == 4: return [t, p, v]
     if i == 5: return [v, p, q]
 
+# wheel(i/256) for i in 0..255 as packed R,G,B bytes, built on first use so animations never touch floats
+_HUE_STEPS = 256
+_hueLUT = None
+
+def hue_lut():
+    global _hueLUT
+    if _hueLUT is None:
+        _hueLUT = bytearray(3*_HUE_STEPS)
+        for i in range(_HUE_STEPS):
+            c = wheel(i/_HUE_STEPS)
+            for j in range(3):
+                _hueLUT[3*i+j] = int(c[j])
+    return _hueLUT
+
 class PiicoDev_RGB(object):
     def setPixel(self,n,c):
         self.led[n]=[round(c[0]),round(c[1]),round(c[2])]
 
     def show(self):
-        buffer = bytes(self.led[0]) + bytes(self.led[1]) + bytes(self.led[2])
-        self.i2c.writeto_mem(self.addr, _regLedVals, buffer)
+        for i in range(3):
+            for j in range(3):
+                self.frame[3*i+j] = self.led[i][j]
+        self.show_frame()
+
+    # Write self.frame (R,G,B x3) as-is, skipping the bus entirely if the LEDs already show it
+    def show_frame(self):
+        if self._shown == self.frame:
+            return
+        self.i2c.writeto_mem(self.addr, _regLedVals, self.frame)
+        self._shown[:] = self.frame
+
+    def frame_changed(self):
+        return self._shown != self.frame
+
+    # show() from an asyncio task, jumping the queue ahead of background sampling on the shared bus
+    async def show_async(self, priority=PRIORITY_HIGH):
+        await self.i2c.arbiter.run(self.show, priority=priority)
 
     def setBrightness(self,x):
         self.bright= round(x) if 0 <= x <= 255 else 255
-        self.i2c.writeto_mem(self.addr, _regBright, bytes([self.bright]))
-        sleep_ms(1)
+        if self.regs.write_if_changed(_regBright, bytes([self.bright])):
+            sleep_ms(1)
 
     def clear(self):
         self.i2c.writeto_mem(self.addr,_regClear,b'\x01')
         self.led=[[0,0,0],[0,0,0],[0,0,0]]
+        self.frame[:] = b'\x00'*9
+        self._shown[:] = self.frame
         sleep_ms(1)
 
     def setI2Caddr(self, newAddr):
@@ -43,6 +75,8 @@ class PiicoDev_RGB(object):
         assert 8 <= x <= 0x77, 'address must be >=0x08 and <=0x77'
         self.i2c.writeto_mem(self.addr, _regI2cAddr, bytes([x]))
         self.addr = x
+        self.regs = self.i2c.shadow(self.addr)
+        self.regs.invalidate()
         sleep_ms(5)
 
     def readFirmware(self):
@@ -55,8 +89,8 @@ class PiicoDev_RGB(object):
     # Control the 'Power' LED. Defaults ON if anything else but False is passed in
     def pwrLED(self, state):
         assert state == True or state == False, 'argument must be True/1 or False/0'
-        self.i2c.writeto_mem(self.addr,_regCtrl,bytes([state]))
-        sleep_ms(1)
+        if self.regs.write_if_changed(_regCtrl, bytes([state])):
+            sleep_ms(1)
         
     def fill(self,c):
         for i in range(len(self.led)):
@@ -71,7 +105,11 @@ class PiicoDev_RGB(object):
         else:
             self.addr = addr # accept an integer
         self.led = [[0,0,0],[0,0,0],[0,0,0]]
+        self.frame = bytearray(9) # R,G,B per LED, written straight to the device
+        self._shown = bytearray(b'\xff'*9) # Last frame written - unknown until the first show()
         self.bright=bright
+        self.regs = self.i2c.shadow(self.addr) # Brightness and control are only ever changed by us
+        self.regs.invalidate()
         try:
             self.setBrightness(bright)
             self.show()
@@ -80,3 +118,132 @@ class PiicoDev_RGB(object):
             raise e
         
         
+
+
+# Runs LED effects from an asyncio task at a fixed frame rate. Effects render straight into leds.frame,
+# so an animation allocates nothing per frame, and a frame that comes out the same as the last one
+# (a held colour, a slow fade between steps) never reaches the I2C bus. While an effect is running the
+# animator owns the LEDs - set the colour through it rather than with setPixel()/show().
+class RGBAnimator:
+    def __init__(self, leds, fps=25, priority=PRIORITY_HIGH):
+        self.leds = leds
+        self.period_ms = 1000 // fps
+        self.priority = priority
+        self._effect = None
+        self._start = 0
+        self._from = bytearray(9)
+        self._to = bytearray(9)
+        self._duration = 0
+        self._param = 0
+        self._wake = asyncio.Event()
+
+    def _set(self, effect):
+        self._effect = effect
+        self._start = ticks_ms()
+        self._wake.set()
+
+    def _target(self, colours):
+        for i in range(3):
+            c = colours[i] if type(colours[0]) in (list, tuple) else colours
+            for j in range(3):
+                self._to[3*i+j] = int(c[j])
+
+    # Fade from whatever is showing now to colour (one [R,G,B] or a list of three)
+    def fade(self, colour, duration_ms=300):
+        self._from[:] = self.leds.frame
+        self._target(colour)
+        self._duration = max(1, duration_ms)
+        self._set(self._renderFade)
+
+    def solid(self, colour):
+        self.fade(colour, 1)
+
+    # Hue cycle, one lap every period_ms, with the LEDs spread around the wheel by `spread` (0-255)
+    def rainbow(self, period_ms=5000, spread=85):
+        self._duration = max(1, period_ms)
+        self._param = spread
+        self._set(self._renderRainbow)
+
+    # On/off blink: on_ms lit, off_ms dark, repeated forever
+    def blink(self, colour, on_ms=500, off_ms=500):
+        self._target(colour)
+        self._duration = on_ms + off_ms
+        self._param = on_ms
+        self._set(self._renderBlink)
+
+    # Triangle-wave brightness between off and colour, one breath every period_ms
+    def breathe(self, colour, period_ms=2000):
+        self._target(colour)
+        self._duration = max(2, period_ms)
+        self._set(self._renderBreathe)
+
+    # Hold the last frame and stop rendering
+    def stop(self):
+        self._effect = None
+
+    def running(self):
+        return self._effect is not None
+
+    # Each render writes leds.frame for time t [ms] since the effect started, returning False once finished
+    def _renderFade(self, t):
+        frame = self.leds.frame
+        if t >= self._duration:
+            frame[:] = self._to
+            return False
+        for k in range(9):
+            a = self._from[k]
+            frame[k] = a + (self._to[k] - a) * t // self._duration
+        return True
+
+    def _renderRainbow(self, t):
+        lut = hue_lut()
+        frame = self.leds.frame
+        h = (t % self._duration) * _HUE_STEPS // self._duration
+        for i in range(3):
+            k = 3*((h + i*self._param) % _HUE_STEPS)
+            frame[3*i] = lut[k]
+            frame[3*i+1] = lut[k+1]
+            frame[3*i+2] = lut[k+2]
+        return True
+
+    def _renderBlink(self, t):
+        frame = self.leds.frame
+        if t % self._duration < self._param:
+            frame[:] = self._to
+        else:
+            for k in range(9):
+                frame[k] = 0
+        return True
+
+    def _renderBreathe(self, t):
+        frame = self.leds.frame
+        half = self._duration // 2
+        phase = t % self._duration
+        level = phase if phase < half else self._duration - phase # 0..half..0
+        for k in range(9):
+            frame[k] = self._to[k] * level // half
+        return True
+
+    # Render and show frames until cancelled. Sleeps between frames (and until an effect is set), so the
+    # web server and sensor sampling always get the loop, and a late frame is dropped rather than bunched.
+    async def run(self):
+        leds = self.leds
+        arbiter = leds.i2c.arbiter
+        nextFrame = ticks_ms()
+        while True:
+            effect = self._effect
+            if effect is None:
+                self._wake.clear()
+                await self._wake.wait()
+                nextFrame = ticks_ms()
+                continue
+            if not effect(ticks_diff(ticks_ms(), self._start)) and self._effect is effect:
+                self._effect = None
+            if leds.frame_changed():
+                await arbiter.run(leds.show_frame, priority=self.priority)
+            nextFrame = ticks_add(nextFrame, self.period_ms)
+            wait = ticks_diff(nextFrame, ticks_ms())
+            if wait < 0: # Fell behind - skip the missed frames
+                nextFrame = ticks_ms()
+                wait = 0
+            await asyncio.sleep(wait/1000)
@@ -8,19 +8,153 @@ i2c_err_str = "PiicoDev could not communicate with module at address 0x{:02X}, c
 
 if _SYSNAME == 'microbit':
     from microbit import i2c
-    from utime import sleep_ms
+    from utime import sleep_ms, ticks_ms, ticks_diff, ticks_add
     
 elif _SYSNAME == 'Linux':
     from smbus2 import SMBus, i2c_msg
-    from time import sleep
+    from ctypes import c_char, create_string_buffer
+    from time import sleep, monotonic
     from math import ceil
     
     def sleep_ms(t):
         sleep(t/1000)
 
+    def ticks_ms():
+        return int(monotonic()*1000)
+
+    def ticks_diff(a, b):
+        return a - b
+
+    def ticks_add(a, b):
+        return a + b
+
 else:
     from machine import I2C
-    from utime import sleep_ms
+    from utime import sleep_ms, ticks_ms, ticks_diff, ticks_add
+
+try:
+    import uasyncio as asyncio
+except ImportError:
+    try:
+        import asyncio
+    except ImportError:
+        asyncio = None # No event loop on this port, the arbiter is unavailable
+
+# Bus arbiter priority lanes, lower runs first
+PRIORITY_HIGH = 0 # User-facing, eg. LED updates
+PRIORITY_NORMAL = 1
+PRIORITY_LOW = 2 # Background sampling
+
+class _ArbiterLane:
+    def __init__(self, arbiter, priority):
+        self.arbiter = arbiter
+        self.priority = priority
+
+    async def __aenter__(self):
+        await self.arbiter.acquire(self.priority)
+        return self.arbiter
+
+    async def __aexit__(self, exc_type, exc, tb):
+        self.arbiter.release()
+
+# Serialises access to one physical bus between asyncio tasks. A multi-step transaction (write a register,
+# then read the result) is done while holding the bus, so another driver's transfer can't land in between.
+# When the bus is released it goes to the oldest waiter in the highest priority lane, so an LED update
+# queued behind background sampling goes next. Nothing is pre-empted mid-transaction.
+class BusArbiter:
+    def __init__(self):
+        self._busy = False
+        self._lanes = ([], [], [])
+
+    def locked(self):
+        return self._busy
+
+    async def acquire(self, priority=PRIORITY_NORMAL):
+        if not self._busy:
+            self._busy = True
+            return
+        ev = asyncio.Event()
+        lane = self._lanes[priority]
+        lane.append(ev)
+        try:
+            await ev.wait() # release() hands the bus straight to us
+        except BaseException: # Cancelled while queued
+            if ev in lane:
+                lane.remove(ev)
+            else:
+                self.release()
+            raise
+
+    def release(self):
+        for lane in self._lanes:
+            if lane:
+                lane.pop(0).set() # Stays busy, ownership moves to the waiter
+                return
+        self._busy = False
+
+    # async with bus.arbiter.lane(PRIORITY_HIGH): ...
+    def lane(self, priority=PRIORITY_NORMAL):
+        return _ArbiterLane(self, priority)
+
+    # Run a synchronous driver call while holding the bus
+    async def run(self, fn, *args, priority=PRIORITY_NORMAL):
+        await self.acquire(priority)
+        try:
+            return fn(*args)
+        finally:
+            self.release()
+
+    # Run queued (fn, args) transactions back-to-back under a single acquisition, returns their results
+    async def batch(self, transactions, priority=PRIORITY_NORMAL):
+        await self.acquire(priority)
+        try:
+            return [fn(*args) for fn, args in transactions]
+        finally:
+            self.release()
+
+_arbiters = {} # One per physical bus
+_buses = {} # Shared bus objects, keyed by everything that was used to create them
+
+# Write-through cache of a device's configuration registers. Reads of a cached register cost no bus traffic,
+# and a read-modify-write becomes a masked update in memory followed by a single write.
+# Only use it for registers that nothing but the driver changes, and invalidate() after a device reset.
+class RegisterShadow:
+    def __init__(self, i2c, addr):
+        self.i2c = i2c
+        self.addr = addr
+        self._regs = {}
+
+    def read(self, reg, nbytes=1):
+        val = self._regs.get(reg)
+        if val is None or len(val) != nbytes:
+            val = bytes(self.i2c.readfrom_mem(self.addr, reg, nbytes))
+            self._regs[reg] = val
+        return val
+
+    def write(self, reg, buf):
+        self.i2c.writeto_mem(self.addr, reg, buf)
+        self._regs[reg] = bytes(buf)
+
+    # Skip the bus entirely if the register already holds buf, returns True if it was written
+    def write_if_changed(self, reg, buf):
+        if self._regs.get(reg) == bytes(buf):
+            return False
+        self.write(reg, buf)
+        return True
+
+    # Set the bits in mask to those of value, leaving the rest. Registers wider than a byte are little endian.
+    def update(self, reg, mask, value, nbytes=1):
+        old = int.from_bytes(self.read(reg, nbytes), 'little')
+        new = (old & ~mask) | (value & mask)
+        if new != old:
+            self.write(reg, new.to_bytes(nbytes, 'little'))
+        return new
+
+    def invalidate(self, reg=None):
+        if reg is None:
+            self._regs = {}
+        else:
+            self._regs.pop(reg, None)
 
 class I2CBase:
     def writeto_mem(self, addr, memaddr, buf, *, addrsize=8):
@@ -29,6 +163,9 @@ class I2CBase:
     def readfrom_mem(self, addr, memaddr, nbytes, *, addrsize=8):
         raise NotImplementedError("readfrom_mem")
 
+    def readfrom_mem_into(self, addr, memaddr, buf, *, addrsize=8):
+        raise NotImplementedError("readfrom_mem_into")
+
     def write8(self, addr, buf, stop=True):
         raise NotImplementedError("write")
 
@@ -38,6 +175,16 @@ class I2CBase:
     def __init__(self, bus=None, freq=None, sda=None, scl=None):
         raise NotImplementedError("__init__")
 
+    # The register shadow for the device at addr, shared by everything using this bus
+    def shadow(self, addr):
+        try:
+            shadows = self._shadows
+        except AttributeError:
+            shadows = self._shadows = {}
+        if addr not in shadows:
+            shadows[addr] = RegisterShadow(self, addr)
+        return shadows[addr]
+
 class I2CUnifiedMachine(I2CBase):
     def __init__(self, bus=None, freq=None, sda=None, scl=None):
         if bus is None:
@@ -50,6 +197,7 @@ class I2CUnifiedMachine(I2CBase):
 
         self.writeto_mem = self.i2c.writeto_mem
         self.readfrom_mem = self.i2c.readfrom_mem
+        self.readfrom_mem_into = self.i2c.readfrom_mem_into
 
     def write8(self, addr, reg, data):
         if reg is None:
@@ -72,6 +220,13 @@ class I2CUnifiedMicroBit(I2CBase):
         i2c.write(addr, ad + buf)
         
     def readfrom_mem(self, addr, memaddr, nbytes, *, addrsize=8):
+        return self._read(addr, memaddr, nbytes, addrsize)
+
+    def readfrom_mem_into(self, addr, memaddr, buf, *, addrsize=8):
+        buf[:] = self._read(addr, memaddr, len(buf), addrsize)
+
+    @staticmethod
+    def _read(addr, memaddr, nbytes, addrsize):
         ad = memaddr.to_bytes(addrsize // 8, 'big')  # pad address for eg. 16 bit
         i2c.write(addr, ad, repeat=True)
         return i2c.read(addr, nbytes)    
@@ -91,14 +246,63 @@ class I2CUnifiedLinux(I2CBase):
         if bus is None:
             bus = 1
         self.i2c = SMBus(bus)
+        # Reused for every transfer: the messages are re-pointed at the caller's buffer instead of copying
+        # through fresh ctypes buffers and per-byte Python loops
+        self._msg_w = i2c_msg.write(0, [0])
+        self._msg_r = i2c_msg.read(0, 1)
+        self._wbuf = bytearray(34) # register address + payload, grown if a bigger write comes along
+        self._idle = create_string_buffer(1) # messages are parked here between transfers
+
+    @staticmethod
+    def _point(msg, addr, buf, length):
+        msg.addr = addr
+        msg.len = length
+        msg.buf = (c_char * length).from_buffer(buf)
+
+    # Register address into the front of the write buffer, returns its length
+    def _reg_msg(self, memaddr, addrsize, extra):
+        if addrsize == 8:
+            n = 1
+        elif addrsize == 16:
+            n = 2
+        else:
+            raise Exception("address must be 8 or 16 bits long only")
+        if n + extra > len(self._wbuf):
+            self._wbuf = bytearray(n + extra)
+        if n == 1:
+            self._wbuf[0] = memaddr
+        else:
+            self._wbuf[0] = memaddr >> 8
+            self._wbuf[1] = memaddr & 0xff
+        return n
+
+    # Fill a caller-owned bytearray/memoryview, as machine.I2C.readfrom_mem_into
+    def readfrom_mem_into(self, addr, memaddr, buf, *, addrsize=8):
+        self._read_into(addr, memaddr, buf, addrsize)
 
     def readfrom_mem(self, addr, memaddr, nbytes, *, addrsize=8):
-        data = [None] * nbytes # initialise empty list
-        self.smbus_i2c_read(addr, memaddr, data, nbytes, addrsize=addrsize)
-        return data
+        buf = bytearray(nbytes)
+        self._read_into(addr, memaddr, buf, addrsize)
+        return bytes(buf)
+
+    def _read_into(self, addr, memaddr, buf, addrsize):
+        n = self._reg_msg(memaddr, addrsize, 0)
+        self._point(self._msg_w, addr, self._wbuf, n)
+        self._point(self._msg_r, addr, buf, len(buf))
+        try:
+            self.i2c.i2c_rdwr(self._msg_w, self._msg_r)
+        finally:
+            self._msg_w.buf = self._idle # Don't keep the buffers exported (and unresizable) between transfers
+            self._msg_r.buf = self._idle
     
     def writeto_mem(self, addr, memaddr, buf, *, addrsize=8):
-        self.smbus_i2c_write(addr, memaddr, buf, len(buf), addrsize=addrsize)
+        n = self._reg_msg(memaddr, addrsize, len(buf))
+        self._wbuf[n:n+len(buf)] = buf
+        self._point(self._msg_w, addr, self._wbuf, n+len(buf))
+        try:
+            self.i2c.i2c_rdwr(self._msg_w)
+        finally:
+            self._msg_w.buf = self._idle
     
     def smbus_i2c_write(self, address, reg, data_p, length, addrsize=8):
         ret_val = 0
@@ -142,11 +346,66 @@ class I2CUnifiedLinux(I2CBase):
         regInt = int.from_bytes(reg, 'big')
         return self.i2c.read_word_data(addr, regInt).to_bytes(2, byteorder='little', signed=False)
 
+# Returns a shared bus object: every driver asking for the same (bus, freq, pins) gets the same instance, so Linux
+# opens one SMBus file descriptor per bus rather than per device and MicroPython initialises I2C once.
+# Each call takes a reference, hand it back with release_unified_i2c() if the driver is done with the bus.
 def create_unified_i2c(bus=None, freq=None, sda=None, scl=None):
     if _SYSNAME == 'microbit':
-        i2c = I2CUnifiedMicroBit(freq=freq)
+        physical = 0
+        key = (physical, freq)
     elif _SYSNAME == 'Linux':
-        i2c = I2CUnifiedLinux(bus=bus)
+        physical = 1 if bus is None else bus
+        key = (physical,)
     else:
-        i2c = I2CUnifiedMachine(bus=bus, freq=freq, sda=sda, scl=scl)
+        physical = 0 if bus is None else bus
+        key = (physical, freq, sda, scl)
+    i2c = _buses.get(key)
+    if i2c is None:
+        if _SYSNAME == 'microbit':
+            i2c = I2CUnifiedMicroBit(freq=freq)
+        elif _SYSNAME == 'Linux':
+            i2c = I2CUnifiedLinux(bus=bus)
+        else:
+            i2c = I2CUnifiedMachine(bus=bus, freq=freq, sda=sda, scl=scl)
+        i2c._key = key
+        i2c._refs = 0
+        _count_transactions(i2c)
+        if asyncio is not None:
+            if physical not in _arbiters:
+                _arbiters[physical] = BusArbiter()
+            i2c.arbiter = _arbiters[physical]
+        _buses[key] = i2c
+    i2c._refs += 1
     return i2c
+
+_COUNTED = ('writeto_mem', 'readfrom_mem', 'readfrom_mem_into', 'write8', 'read16')
+
+# Wrap the bus methods so every transaction, and every one that fails, is counted per device address in i2c.stats
+def _count_transactions(i2c):
+    stats = i2c.stats = {} # addr: [transactions, errors]
+    def counted(fn):
+        def call(addr, *args, **kwargs):
+            entry = stats.get(addr)
+            if entry is None:
+                entry = stats[addr] = [0, 0]
+            entry[0] += 1
+            try:
+                return fn(addr, *args, **kwargs)
+            except OSError:
+                entry[1] += 1
+                raise
+        return call
+    for name in _COUNTED:
+        setattr(i2c, name, counted(getattr(i2c, name)))
+
+# (physical bus, {addr: [transactions, errors]}) for every bus in use
+def bus_stats():
+    return [(i2c._key[0], i2c.stats) for i2c in _buses.values()]
+
+def release_unified_i2c(i2c):
+    i2c._refs -= 1
+    if i2c._refs > 0:
+        return
+    _buses.pop(i2c._key, None)
+    if _SYSNAME == 'Linux':
+        i2c.i2c.close()
@@ -10,10 +10,21 @@ _veml6030Address = 0x10
 _ALS_CONF = 0x00
 _REG_ALS = 0x04
 
-_DEFAULT_SETTINGS = b'\x00' # initialise gain:1x, integration 100ms, persistence 1, disable interrupt
+_DEFAULT_SETTINGS = b'\x00\x00' # initialise gain:1x, integration 100ms, persistence 1, disable interrupt
+
+# ALS_CONF field codes
+_GAIN_BITS = {1: 0b00, 2: 0b01, 0.125: 0b10, 0.25: 0b11} # bits 12:11
+_IT_BITS = {25: 0b1100, 50: 0b1000, 100: 0b0000, 200: 0b0001, 400: 0b0010, 800: 0b0011} # bits 9:6
+_GAIN_MASK = 0b11 << 11
+_IT_MASK = 0b1111 << 6
+
+# Auto-ranging ladder of (gain, integration time [ms]), most sensitive first. Each step doubles the resolution [lx/bit].
+_RANGES = ((2, 800), (2, 400), (2, 200), (2, 100), (1, 100), (1, 50), (1, 25), (0.25, 50), (0.125, 50), (0.125, 25))
+_RANGE_HIGH = 50000 # Raw counts above this move to a less sensitive range...
+_RANGE_LOW = 10000 # ...and below this to a more sensitive one. Steps double the count, so there is room for hysteresis.
 
 class PiicoDev_VEML6030(object):
-    def __init__(self, bus=None, freq=None, sda=None, scl=None, addr=_veml6030Address):
+    def __init__(self, bus=None, freq=None, sda=None, scl=None, addr=_veml6030Address, autoRange=False):
         try:
             if compat_ind >= 1:
                 pass
@@ -24,52 +35,104 @@ class PiicoDev_VEML6030(object):
         self.i2c = create_unified_i2c(bus=bus, freq=freq, sda=sda, scl=scl)
         self.addr = addr
         self.gain=1
+        self.integration_ms = 100
         self.res = 0.0576 # [lx/bit]
-        self.i2c.writeto_mem(self.addr, _ALS_CONF, _DEFAULT_SETTINGS)
+        self.autoRange = False
+        self._range = _RANGES.index((1, 100))
+        self._settleUntil = None # ticks_ms when data from the new range is ready
+        self._lastLux = float('NaN')
+        self.regs = self.i2c.shadow(self.addr) # ALS_CONF is only ever changed by us
+        self.regs.invalidate()
+        self.regs.write(_ALS_CONF, _DEFAULT_SETTINGS)
         sleep_ms(4)
+        if autoRange:
+            self.setAutoRange(True)
         
     def read(self):
+        if self.autoRange and self._settleUntil is not None:
+            if ticks_diff(self._settleUntil, ticks_ms()) > 0: # New range still integrating, the register holds old data
+                return self._lastLux
+            self._settleUntil = None
         try:
             data = self.i2c.readfrom_mem(self.addr, _REG_ALS, 2)
         except:
             print(i2c_err_str.format(self.addr))
             return float('NaN')
-        return int.from_bytes(data, 'little') * self.res
-    
+        raw = int.from_bytes(data, 'little')
+        lux = raw * self.res
+        if self.autoRange:
+            if raw < 0xFFFF or self._lastLux != self._lastLux:
+                self._lastLux = lux
+            self._autoRange(raw)
+            return self._lastLux # Saturated readings are a lower bound only, hold the last good one instead
+        return lux
+
+    # Effective resolution of the current setting [lx/bit]
+    def resolution(self):
+        return self.res
+
+    # Let read() move between gain and integration time settings to keep the raw count in range
+    def setAutoRange(self, on=True):
+        self.autoRange = on
+        if on:
+            self._range = self._closestRange()
+            self._applyRange(self._range)
+
+    def _closestRange(self):
+        for i in range(len(_RANGES)):
+            if self._resFor(*_RANGES[i]) >= self.res:
+                return i
+        return len(_RANGES)-1
+
+    def _autoRange(self, raw):
+        target = self._range
+        if raw > _RANGE_HIGH:
+            target = min(len(_RANGES)-1, target + 1 + (raw == 0xFFFF)) # Saturated: the light may be far brighter, jump further
+        elif raw < _RANGE_LOW:
+            # Most sensitive range whose expected count still stays under the high threshold
+            lux = raw * self.res
+            target = 0
+            while target < self._range and lux / self._resFor(*_RANGES[target]) > _RANGE_HIGH // 2:
+                target += 1
+        if target != self._range:
+            oldIt = self.integration_ms
+            self._applyRange(target)
+            self._settleUntil = ticks_add(ticks_ms(), oldIt + self.integration_ms + 10)
+
+    def _applyRange(self, i):
+        self._range = i
+        gain, it = _RANGES[i]
+        self.regs.update(_ALS_CONF, _GAIN_MASK | _IT_MASK, _GAIN_BITS[gain] << 11 | _IT_BITS[it] << 6, 2)
+        self.gain = gain
+        self.integration_ms = it
+        self.res = self._resFor(gain, it)
+
+    @staticmethod
+    def _resFor(gain, it):
+        return 0.0576 * (100/it) / gain
+
+    # Setting the gain or integration time by hand turns auto-ranging off, or read() would move away from it again.
+    # setAutoRange(True) hands control back, starting from the closest range.
     def setGain(self,g):
         if g not in [0.125,0.25,1,2]:
             raise ValueError ('Invalid gain. Accepted values: 0.125, 0.25, 1, 2')
+        self.autoRange = False
         self.gain=g
-        if g == 0.125:
-            conf = b'\x00\x10'
-            self.res = 0.4608
-        if g == 0.25:
-            conf = b'\x00\x18'
-            self.res = 0.2304
-        if g == 1:
-            conf = b'\x00\x00'
-            self.res = 0.0576
-        if g == 2:
-            conf = b'\x00\x08'
-            self.res = 0.0288
-        self.setBits(_ALS_CONF, conf, 'b\x18\x00')
+        self.res = self._resFor(g, self.integration_ms)
+        self.regs.update(_ALS_CONF, _GAIN_MASK, _GAIN_BITS[g] << 11, 2)
         sleep_ms(4)
         return
+
+    def setIntegrationTime(self, it):
+        if it not in _IT_BITS:
+            raise ValueError ('Invalid integration time. Accepted values: 25, 50, 100, 200, 400, 800')
+        self.autoRange = False
+        self.integration_ms = it
+        self.res = self._resFor(self.gain, it)
+        self.regs.update(_ALS_CONF, _IT_MASK, _IT_BITS[it] << 6, 2)
+        sleep_ms(4)
     
-    def setBits(self, address, byte, mask): # ToDo: generalise for 8 or 16bit registers. Make more elegant.
-        old = self.i2c.readfrom_mem(self.addr, address, 2)
-        old_byte = int.from_bytes(self.i2c.readfrom_mem(self.addr, address, 2),'little')
-        temp_byte = old_byte
-        int_byte = int.from_bytes(byte,"little")
-        int_mask = int.from_bytes(mask,"big")
-        for n in range(16): # Cycle through each bit
-            bit_mask = (int_mask >> n) & 1
-            if bit_mask == 1:
-                if ((int_byte >> n) & 1) == 1:
-                    temp_byte = temp_byte | 1 << n
-                else:
-                    temp_byte = temp_byte & ~(1 << n)
-        new_byte = temp_byte
-        print(new_byte)
-        self.i2c.writeto_mem(self.addr, address, new_byte.to_bytes(2,'little'))
-          
+    # Masked write of a 16 bit register: byte is little endian (as the register), mask is big endian.
+    # Goes through the register shadow, so it costs a single bus write.
+    def setBits(self, address, byte, mask):
+        self.regs.update(address, int.from_bytes(mask, 'big'), int.from_bytes(byte, 'little'), 2)
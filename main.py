@@ -15,6 +15,16 @@ import network
 import uasyncio as asyncio
 from machine import Pin
 import time
+import json
+import struct
+
+import hs_http
+import hs_history
+import hs_flashlog
+import hs_websocket
+import hs_metrics
+import hs_wifi
+import hs_oled
 
 # import custWebpage # TODO
 
@@ -23,15 +33,17 @@ from PiicoDev_Unified import sleep_ms
 from PiicoDev_SSD1306 import * 
 from PiicoDev_BME280 import PiicoDev_BME280
 from PiicoDev_VEML6030 import PiicoDev_VEML6030
-from PiicoDev_RGB import PiicoDev_RGB, wheel
+from PiicoDev_RGB import PiicoDev_RGB, RGBAnimator, wheel
 
 # Create PiicoDev sensor objects
-atmo = PiicoDev_BME280()
-lght = PiicoDev_VEML6030()
+atmo = PiicoDev_BME280(normal_mode=True, t_sb=5) # Converts every ~1s in the background, reads are a single burst
+lght = PiicoDev_VEML6030(autoRange=True) # Usable from dim rooms to direct sunlight
 leds = PiicoDev_RGB()
+ledAnim = RGBAnimator(leds) # Smooth colour changes without blocking the webserver
 
+dashboard = None # Readings and status on the OLED, see oledDashboard()
 try:
-    display = create_PiicoDev_SSD1306()
+    dashboard = hs_oled.Dashboard(create_PiicoDev_SSD1306())
 except:
     print('OLED not plugged in')
 
@@ -39,19 +51,23 @@ led = Pin("LED", Pin.OUT, value=1)
 
 
 
-def showIP(ipStr):
-    try:
-        display.text(ipStr, 0,0, 1)
-        display.show()
-    except:
-        print('OLED not plugged in')
-
-
 # Configure your WiFi SSID and password
 ssid = 'projectRouter'
 password = 'password1'
 
 check_interval_sec = 0.25
+sample_interval_sec = 1 # How often the sampler refreshes the sensor snapshot
+
+# Latest sensor readings, refreshed by sampleSensors() - clients only ever read from here
+sensorSnapshot = {'seq': 0, 'ticks': None, 'time': None, 'readings': None}
+snapshotEvent = asyncio.Event() # Pulsed every time the snapshot is refreshed
+
+# Raw readings plus 1-min and 15-min rollups, served downsampled at /history?range=&step= [s]
+history = hs_history.History(['temperature', 'pressure', 'humidity', 'lux'])
+
+# Readings that survive reboots and WiFi outages, read back at /log?from=&to= [s] as '<Iffff' records
+log_interval_sec = 60
+sensorLog = hs_flashlog.FlashLog(4)
 
 wlan = network.WLAN(network.STA_IF)
 
@@ -78,6 +94,7 @@ colour = '''
 script = '''<script>
 
 let colorWell;
+let colourSocket = null;
 const defaultColor = "#000000";
 window.addEventListener("load", startup, false);
 
@@ -86,9 +103,18 @@ function startup() {
     colorWell.value = defaultColor;
     colorWell.addEventListener("input", updateFirst, false);
     colorWell.select();
+    if (!!window.WebSocket) {
+        colourSocket = new WebSocket("ws://" + location.host + "/ws");
+        colourSocket.binaryType = "arraybuffer";
+    }
 }
 
 function updateFirst(event) {
+    if (colourSocket && colourSocket.readyState == 1) {
+        var rgb = parseInt(String(event.target.value).substr(1), 16);
+        colourSocket.send(new Uint8Array([rgb >> 16, (rgb >> 8) & 255, rgb & 255]));
+        return;
+    }
     var xhttp = new XMLHttpRequest();
     xhttp.onreadystatechange = function() {
     if (this.readyState == 4 && this.status == 200) {
@@ -99,9 +125,27 @@ function updateFirst(event) {
     xhttp.send();
 }
 
-setInterval(function() {
-  getSensors();
-}, 500);
+var sensorPoll = null;
+function pollSensors() {
+  if (sensorPoll == null) {
+    sensorPoll = setInterval(function() {
+      getSensors();
+    }, 500);
+  }
+}
+if (!!window.EventSource) {
+  var sensorSource = new EventSource("events");
+  sensorSource.onmessage = function(event) {
+    document.getElementById("sensors").innerHTML = event.data;
+  };
+  sensorSource.onerror = function() {
+    if (sensorSource.readyState == 2) { // Refused (eg. 503 when the server is full), browsers don't retry that
+      pollSensors();
+    }
+  };
+} else {
+  pollSensors();
+}
 
 function getSensors() {
   var xhttp = new XMLHttpRequest();
@@ -117,70 +161,111 @@ function getSensors() {
 '''
 
 
+# The index page only depends on the template strings, so render it once and serve the cached bytes
+_indexPage = None
+
+def indexPage():
+    global _indexPage
+    if _indexPage is None:
+        _indexPage = hs_http.CachedPage(html.format(script=script,colour=colour))
+    return _indexPage
+
+# Call after changing html, colour or script
+def invalidateIndex():
+    global _indexPage
+    _indexPage = None
+
 def requestBreakdown(request):
     return request.split()
 
-def blink_led(frequency = 0.5, num_blinks = 3):
-    for _ in range(num_blinks):
-        led.on()
-        time.sleep(frequency)
-        led.off()
-        time.sleep(frequency)
-
-async def connect_to_wifi():
-    wlan.active(True)
-    wlan.config(pm = 0xa11140)  # Diable powersave mode
-    wlan.connect(ssid, password)
-    
-    # Wait for connect or fail
-    max_wait = 10
-    while max_wait > 0:
-        if wlan.status() < 0 or wlan.status() >= 3:
-            break
-        max_wait -= 1
-        print('waiting for connection...')
-        time.sleep(1)
-
-    # Handle connection error
-    if wlan.status() != 3:
-        blink_led(0.1, 10)
-        raise RuntimeError('WiFi connection failed')
+wifi = hs_wifi.WiFi(wlan, ssid, password) # Connects, and reconnects whenever the link drops
+
+
+# Route handlers, called as handler(req, writer, keepAlive). See hs_http.Router.
+def serveIndex(req, writer, keepAlive):
+    fadeLight([[0,0,0]]*3)
+    indexPage().send(writer, req, keepAlive=keepAlive)
+
+def serveSensors(req, writer, keepAlive):
+    sensorUpdateStr = htmlifyLstStr(lstStrSnapshot())
+    hs_http.sendResponse(writer, sensorUpdateStr, keepAlive=keepAlive)
+
+def serveApi(req, writer, keepAlive):
+    api = apiSensors()
+    if api is None:
+        hs_http.sendResponse(writer, 'No readings yet', ctype='text/plain', status='503 Service Unavailable', keepAlive=keepAlive)
+    elif req.pathIs(b'/api/sensors'):
+        hs_http.sendResponse(writer, api[0], ctype='application/json', keepAlive=keepAlive)
     else:
-        blink_led(0.5, 2)
-        print('connected')
-        status = wlan.ifconfig()
-        print('ip = ' + status[0])
-        showIP(status[0])
+        hs_http.sendResponse(writer, api[1], ctype='application/octet-stream', keepAlive=keepAlive)
 
+def serveHistory(req, writer, keepAlive):
+    try:
+        rangeSec = max(1, req.queryInt(b'range', 3600))
+        step = max(1, req.queryInt(b'step', 60))
+    except ValueError:
+        hs_http.sendResponse(writer, 'range and step must be whole seconds', ctype='text/plain', status='400 Bad Request', keepAlive=keepAlive)
+    else:
+        hs_http.sendResponse(writer, history.toJSON(int(time.time()), rangeSec, step), ctype='application/json', keepAlive=keepAlive)
+
+def serveLog(req, writer, keepAlive):
+    try:
+        t0 = req.queryInt(b'from', 0)
+        t1 = req.queryInt(b'to', int(time.time()))
+    except ValueError:
+        hs_http.sendResponse(writer, 'from and to must be whole seconds', ctype='text/plain', status='400 Bad Request', keepAlive=keepAlive)
+    else:
+        hs_http.sendResponse(writer, sensorLog.read(t0, t1), ctype='application/octet-stream', keepAlive=keepAlive,
+                             headers='X-Record-Format: {}\r\n'.format(sensorLog.fmt))
+
+async def serveEvents(req, writer, keepAlive):
+    if not hs_http.startStream(req):
+        hs_http.sendError(writer, hs_http.UNAVAILABLE, keepAlive=keepAlive, headers='Retry-After: 10\r\n')
+        return False
+    writer.write(b'HTTP/1.0 200 OK\r\nContent-type: text/event-stream\r\nCache-Control: no-cache\r\n\r\n')
+    await hs_http.streamEvents(writer, snapshotEvent, sensorEvent)
+    return True
+
+def serveLedSet(req, writer, keepAlive):
+    try:
+        lightOut = strToLight(req.query(b'state', ''))
+    except ValueError:
+        hs_http.sendResponse(writer, 'state must be RRGGBB hex', ctype='text/plain', status='400 Bad Request', keepAlive=keepAlive)
+        return
+    fadeLight([lightOut]*3)
+    hs_http.sendResponse(writer, keepAlive=keepAlive)
+
+async def serveWebSocket(req, writer, keepAlive):
+    wsKey = req.get(b'sec-websocket-key')
+    if wsKey is None:
+        hs_http.sendError(writer, 404, keepAlive=keepAlive)
+        return False
+    if not hs_http.startStream(req):
+        hs_http.sendError(writer, hs_http.UNAVAILABLE, keepAlive=keepAlive, headers='Retry-After: 10\r\n')
+        return False
+    if req.query(b'sensors') == '1': # Optionally push the sensors down the same socket
+        await hs_websocket.serve(req.reader, writer, wsKey, wsLight, snapshotEvent, lambda: htmlifyLstStr(lstStrSnapshot()))
+    else:
+        await hs_websocket.serve(req.reader, writer, wsKey, wsLight)
+    return True
+
+def serveMetrics(req, writer, keepAlive):
+    hs_http.sendResponse(writer, hs_metrics.render(), ctype='text/plain; version=0.0.4', keepAlive=keepAlive)
+
+routes = hs_http.Router()
+routes.add('/', serveIndex)
+routes.add('/sensors', serveSensors)
+routes.add('/api/sensors', serveApi)
+routes.add('/api/sensors.bin', serveApi)
+routes.add('/history', serveHistory)
+routes.add('/log', serveLog)
+routes.add('/events', serveEvents)
+routes.add('/led_set', serveLedSet)
+routes.add('/ws', serveWebSocket)
+routes.add('/metrics', serveMetrics)
 
 async def serve_client(reader, writer):
-    print("Client connected")
-    request_line = await reader.readline()
-    print("Request:", request_line)
-    # We are not interested in HTTP request headers, skip them
-    while await reader.readline() != b"\r\n":
-        pass
-    request = str(request_line)
-    
-    cmd_rq = requestBreakdown(request)
-    
-    if cmd_rq[1] == '/':
-        writer.write('HTTP/1.0 200 OK\r\nContent-type: text/html\r\n\r\n')
-        response = html.format(sensors=htmlifyLstStr(lstStrSensors(atmo,lght)),script=script,colour=colour)
-        pushLight(leds,[[0,0,0]]*3)
-        writer.write(response)
-        
-    elif cmd_rq[1] == '/sensors':
-        sensorUpdateStr = htmlifyLstStr(lstStrSensors(atmo,lght))
-        writer.write(sensorUpdateStr)
-
-    elif cmd_rq[1][:15] == '/led_set?state=':
-        lightOut = strToLight(cmd_rq[1][15:])
-        pushLight(leds,[lightOut]*3)
-
-    await writer.drain()
-    await writer.wait_closed()
-    print("Client disconnected")
+    await hs_http.serve(reader, writer, routes)
 
 
 # Get converted Atmo Data
@@ -199,6 +284,16 @@ def pushLight(leds,colLst):
     leds.setPixel(2, colLst[2])
     leds.show()
 
+# Fade to the new colours on the animator task, so a burst of picker events is one smooth glide
+light_fade_ms = 150
+def fadeLight(colLst):
+    ledAnim.fade(colLst, light_fade_ms)
+
+# Binary WebSocket colour command: 3 bytes R G B
+def wsLight(payload):
+    if len(payload) >= 3:
+        fadeLight([[payload[0],payload[1],payload[2]]]*3)
+
 def strToLight(a):
     hex_pref = '0x'
     return [int(hex_pref+a[0:2]),int(hex_pref+a[2:4]),int(hex_pref+a[4:6])]
@@ -207,10 +302,83 @@ def getSensors(atmo,lght):
     tempC, preshPa, humRH = getAtmo(atmo)
     return [tempC, preshPa, humRH, getLight(lght)]
 
+# As getSensors, but the BME280 conversion doesn't hold up the webserver
+async def getSensorsAsync(atmo,lght):
+    tempC, presPa, humRH = await atmo.values_async()
+    return [tempC, presPa/100, humRH, getLight(lght)]
+
 def lstStrSensors(atmo,lght):
-    tempC, preshPa, humRH, lux = getSensors(atmo,lght)
+    return lstStrReadings(getSensors(atmo,lght))
+
+def lstStrReadings(readings):
+    tempC, preshPa, humRH, lux = readings
     return ["Temp: {:.1f} &#8451;".format(tempC),"Press: {:.0f}hPa".format(preshPa),"RH: {:.1f}%".format(humRH),"Lux: {:.1f}".format(lux)]
 
+def lstStrSnapshot():
+    if sensorSnapshot['readings'] is None:
+        return ["Getting sensor state..."]
+    return lstStrReadings(sensorSnapshot['readings'])
+
+# The only task that talks to the sensors, however many clients are connected
+async def sampleSensors(atmo, lght, interval=sample_interval_sec):
+    while True:
+        try: # One bad pass mustn't end the only task that reads the sensors
+            t0 = time.ticks_us()
+            sensorSnapshot['readings'] = await getSensorsAsync(atmo,lght)
+            hs_metrics.sampleTime.since(t0)
+            sensorSnapshot['ticks'] = time.ticks_ms()
+            sensorSnapshot['time'] = int(time.time())
+            history.add(sensorSnapshot['time'], sensorSnapshot['readings'])
+            logReadings(sensorSnapshot['time'], sensorSnapshot['readings'])
+            sensorSnapshot['seq'] += 1
+            snapshotEvent.set() # Wake every /events stream, then re-arm for the next sample
+            snapshotEvent.clear()
+        except Exception as e:
+            hs_metrics.sampleErrors.inc()
+            print('Sampling failed:', e)
+        await asyncio.sleep(interval)
+
+# Persist one reading per log_interval_sec, the logger batches them into page-sized flash writes
+_lastLogged = None
+
+def logReadings(t, readings):
+    global _lastLogged
+    if not hs_wifi.clockSet: # Timestamps would restart from the same value every boot
+        return
+    if _lastLogged is not None and t - _lastLogged < log_interval_sec:
+        return
+    _lastLogged = t
+    try:
+        sensorLog.append(t, readings)
+    except Exception as e: # Flash full or gone - keep sampling regardless
+        print('Sensor log write failed:', e)
+
+# Machine-readable snapshot for collectors, encoded once per sample however many clients ask.
+# /api/sensors.bin layout (little endian, 20 bytes): uint32 time [s], float32 temp [degC], pressure [hPa], RH [%], lux
+API_BIN_FORMAT = '<Iffff'
+_apiCache = {'seq': -1, 'api': None}
+
+def apiSensors():
+    if sensorSnapshot['readings'] is None:
+        return None
+    if _apiCache['seq'] != sensorSnapshot['seq']:
+        t = sensorSnapshot['time']
+        tempC, preshPa, humRH, lux = [x if x == x else None for x in sensorSnapshot['readings']] # NaN isn't valid JSON
+        apiJSON = json.dumps({'time': t, 'temperature': tempC, 'pressure': preshPa, 'humidity': humRH, 'lux': lux})
+        apiBin = struct.pack(API_BIN_FORMAT, t, *sensorSnapshot['readings'])
+        _apiCache['api'] = (apiJSON.encode(), apiBin)
+        _apiCache['seq'] = sensorSnapshot['seq']
+    return _apiCache['api']
+
+# The /events payload, encoded once per sample however many streams are open
+_eventCache = {'seq': -1, 'data': None}
+
+def sensorEvent():
+    if _eventCache['seq'] != sensorSnapshot['seq']:
+        _eventCache['data'] = ('data: ' + htmlifyLstStr(lstStrSnapshot()) + '\n\n').encode()
+        _eventCache['seq'] = sensorSnapshot['seq']
+    return _eventCache['data']
+
 def htmlifyLstStr(lst):
     sensStr = ''
     for x in lst:
@@ -219,9 +387,40 @@ def htmlifyLstStr(lst):
         sensStr += '</p>'
     return sensStr
 
+# WiFi status, readings and client count, updated on every sample and at least once a second.
+# The dashboard only pushes the characters that changed.
+async def oledDashboard():
+    asyncio.create_task(dashboard.run())
+    while True:
+        dashboard.setLine(0, wifi.ip if wifi.state == hs_wifi.CONNECTED else 'WiFi ' + hs_wifi.STATE_NAMES[wifi.state])
+        readings = sensorSnapshot['readings']
+        if readings is not None:
+            tempC, preshPa, humRH, lux = readings
+            dashboard.setLine(2, 'Temp  {:6.1f} C'.format(tempC))
+            dashboard.setLine(3, 'Press {:6.0f} hPa'.format(preshPa))
+            dashboard.setLine(4, 'RH    {:6.1f} %'.format(humRH))
+            dashboard.setLine(5, 'Light {:6.0f} lx'.format(lux))
+        dashboard.setLine(7, 'Clients {}'.format(hs_metrics.activeConnections.value))
+        try:
+            await asyncio.wait_for(snapshotEvent.wait(), 1)
+        except asyncio.TimeoutError:
+            pass
+
 async def main():
     print('Connecting to WiFi...')
-    asyncio.create_task(connect_to_wifi())
+    asyncio.create_task(wifi.run())
+    asyncio.create_task(hs_wifi.statusLed(led, wifi))
+
+    print('Starting sensor sampler...')
+    asyncio.create_task(sampleSensors(atmo, lght))
+
+    print('Starting LED animator...')
+    asyncio.create_task(ledAnim.run())
+
+    if dashboard is not None:
+        asyncio.create_task(oledDashboard())
+
+    asyncio.create_task(hs_metrics.gcTask()) # Short, timed collections between requests
 
     print('Setting up webserver...')
     asyncio.create_task(asyncio.start_server(serve_client, "0.0.0.0", 80))
@@ -17,18 +17,21 @@ from machine import Pin
 
 
 from homestation import *
+import hs_flashlog
+import hs_metrics
 
 from PiicoDev_Unified import sleep_ms
 
 from PiicoDev_SSD1306 import * 
 from PiicoDev_BME280 import PiicoDev_BME280
 from PiicoDev_VEML6030 import PiicoDev_VEML6030
-from PiicoDev_RGB import PiicoDev_RGB, wheel
+from PiicoDev_RGB import PiicoDev_RGB, RGBAnimator, wheel
 
 # Create PiicoDev sensor objects
-atmo = PiicoDev_BME280()
-lght = PiicoDev_VEML6030()
+atmo = PiicoDev_BME280(normal_mode=True, t_sb=5) # Converts every ~1s in the background, reads are a single burst
+lght = PiicoDev_VEML6030(autoRange=True) # Usable from dim rooms to direct sunlight
 leds = PiicoDev_RGB()
+ledAnim = RGBAnimator(leds) # Smooth colour changes without blocking the webserver
 
 try:
     display = create_PiicoDev_SSD1306()
@@ -70,18 +73,19 @@ def getAtmo(atmo):
 def getLight(lght):
     return lght.read() # Lux
 
-def atmoSplit():
-    tempC, presPa, humRH = atmo.values()
+async def atmoSplit():
+    tempC, presPa, humRH = await atmo.values_async()
     return tempC, presPa/100, humRH #[degC,hPa,RH]
 
 
-# sensorData = {
-#     ".Atmo": atmoSplit,
-#     "Temperature :": ['Atmo',0],
-#     "Pressure": ['Atmo',1],
-#     "Humidity": ['Atmo',2],
-#     "Light": lght.read,
-# }
+# The BME280 group is read once per cycle and fans out to its three fields.
+# Light is cheap and changes fastest, so it is polled more often than the atmospheric readings.
+sensorData = SensorRegistry()
+sensorData.addGroup("Atmo", atmoSplit, interval=2)
+sensorData.addField("Temperature:", 'Atmo', 0, units=' &#8451;', fmt='{:.1f}')
+sensorData.addField("Pressure:", 'Atmo', 1, units='hPa', fmt='{:.0f}')
+sensorData.addField("Humidity:", 'Atmo', 2, units='%', fmt='{:.1f}')
+sensorData.addSensor("Light:", lght.read, interval=0.5, units='lx', fmt='{:.1f}')
 
 
 #Push the RBG Value to the RGB module and show it
@@ -99,14 +103,26 @@ def getSensors(atmo,lght): # CHANGE THIS TO A DICT, key is the text and value is
     tempC, preshPa, humRH = getAtmo(atmo)
     return [tempC, preshPa, humRH, getLight(lght)]
 
-sensorData = 'Update plox'
+setLightHandler(lambda colour: ledAnim.fade(colour, 150))
+
+setSensorLog(hs_flashlog.FlashLog(4)) # Temperature, Pressure, Humidity, Light
 
 async def main():
     print('Connecting to WiFi...')
     asyncio.create_task(connect_to_wifi(wlan_param))
 
+    print('Starting sensor sampler...')
+    asyncio.create_task(sampleSensors(sensorData))
+
+    print('Starting LED animator...')
+    asyncio.create_task(ledAnim.run())
+
+    asyncio.create_task(oledDashboard()) # Live readings on the OLED, if there is one
+
+    asyncio.create_task(hs_metrics.gcTask()) # Short, timed collections between requests
+
     print('Setting up webserver...')
-    asyncio.create_task(asyncio.start_server(lambda r,w: serve_client(r,w,sensors=sensorData), "0.0.0.0", 80))
+    asyncio.create_task(asyncio.start_server(serve_client, "0.0.0.0", 80))
 
     while True:
         await asyncio.sleep(check_interval_sec)